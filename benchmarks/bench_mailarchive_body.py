@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+# Benchmark for reading mail-archive.com message pages
+#
+# Compares MessageMailArchive.processMailArchiveMessage in
+# centos-errata.py, which parses each page once with lxml, against the
+# previous line by line extraction. Both must give the same date and
+# packages for the pages in testdata/mailarchive and for an older page
+# with md5 checksums. A synthetic page listing hundreds of packages per
+# architecture is also timed.
+#
+# Usage: python benchmarks/bench_mailarchive_body.py [iterations]
+
+import glob
+import imp
+import os
+import re
+import sys
+import timeit
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ce = imp.load_source('centos_errata',os.path.join(TOP_DIR,'centos-errata.py'))
+
+#The extraction used before the lxml version
+MAILARCHIVE_DATE = "<span class=\"date\">(?P<datestr>[^<]*)</span>"
+dates_re = re.compile(MAILARCHIVE_DATE)
+body_start_re = re.compile("<pre>")
+body_end_re = re.compile("</pre>")
+checksum_re = re.compile("(?P<checksum>\S{64,})")
+rpm_file_re = re.compile("(?P<pkg_filename>[\.\w-]+.rpm)")
+
+def legacy_process_message(parser,parsed_msg,message_src):
+    dates_match = dates_re.search(message_src,re.MULTILINE)
+
+    if not dates_match is None:
+        parsed_msg.errataDate=dates_match.group('datestr')
+
+    message_body=""
+    accumulate=False
+    current_checksum=None
+    current_rpm=None
+    for line in message_src.split("\n"):
+        if body_start_re.match(line):
+            accumulate=True
+
+        if body_end_re.match(line):
+            accumulate=False
+
+        if accumulate:
+            checksum_match = checksum_re.match(line)
+            rpm_match = rpm_file_re.match(line)
+
+            if checksum_match is not None:
+                current_checksum = checksum_match.group('checksum')
+
+            if rpm_match is not None:
+                current_rpm = rpm_match.group('pkg_filename')
+
+            if current_checksum is not None and current_rpm is not None:
+                message_body+="%s %s\n" % (current_checksum,current_rpm)
+                current_checksum=None
+                current_rpm=None
+            elif checksum_match is None and rpm_match is None:
+                message_body+=line+"\n"
+
+    parsed_msg.packageByArch = parser.processPackageList(message_body)
+    return parsed_msg
+
+#Discards the progress messages printed for each page
+class NullOutput:
+    def write(self,text):
+        pass
+
+def process_message(parser,parsed_msg,message_src):
+    real_stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        return parser.processMailArchiveMessage(parsed_msg,"",message_src)
+    finally:
+        sys.stdout = real_stdout
+
+def message_summary(parsed_msg):
+    packages = {}
+    for arch, arch_packages in parsed_msg.packageByArch.items():
+        packages[arch] = [(p.architecture,p.checksum,p.filename) for p in arch_packages]
+    return (parsed_msg.errataDate,packages)
+
+#Build a message page in the mail-archive.com layout listing
+#package_count packages per architecture
+def synthetic_page(package_count):
+    lines = ["<html><body>",
+             "<div class=\"msgHead\"><span class=\"date\">Wed, 28 Dec 2011 09:01:52 -0800</span></div>",
+             "<div class=\"msgBody\">",
+             "<pre>",
+             "CentOS Errata and Security Advisory 2012:0000 Important",
+             ""]
+    for arch in ("i386","x86_64"):
+        lines.append("%s:" % arch)
+        for i in range(package_count):
+            lines.append("%064x  " % i)
+            lines.append("kernel-module-%d-2.6.18-308.el5.%s.rpm" % (i,arch))
+        lines.append("")
+    lines.extend(["-- ","Johnny Hughes","</pre>","</div>","</body></html>"])
+    return "\n".join(lines)
+
+#Build a message page from before the sha256 checksums, where each md5
+#checksum and its package filename share a line
+def md5_page():
+    lines = ["<html><body>",
+             "<div class=\"msgHead\"><span class=\"date\">Tue, 05 Jan 2010 12:13:14 -0800</span></div>",
+             "<div class=\"msgBody\">",
+             "<pre>",
+             "CentOS Errata and Security Advisory 2010:0001 Important",
+             ""]
+    for arch in ("i386","x86_64"):
+        lines.append("%s:" % arch)
+        for i in range(3):
+            lines.append("%032x  foo-%d-1.0-1.el5.%s.rpm" % (i,i,arch))
+        lines.append("")
+    lines.extend(["-- ","Karanbir Singh","</pre>","</div>","</body></html>"])
+    return "\n".join(lines)
+
+def run_benchmark(name,pages,iterations):
+    parser = ce.MessageMailArchive(None)
+
+    for message_src in pages:
+        legacy = message_summary(legacy_process_message(parser,ce.MessageAnnounce(),message_src))
+        current = message_summary(process_message(parser,ce.MessageAnnounce(),message_src))
+        if legacy != current:
+            print "%s: results differ between implementations" % name
+            print legacy
+            print current
+            sys.exit(1)
+
+    def run_legacy():
+        for message_src in pages:
+            legacy_process_message(parser,ce.MessageAnnounce(),message_src)
+
+    def run_lxml():
+        for message_src in pages:
+            process_message(parser,ce.MessageAnnounce(),message_src)
+
+    legacy_time = min(timeit.repeat(run_legacy,repeat=3,number=iterations))
+    lxml_time = min(timeit.repeat(run_lxml,repeat=3,number=iterations))
+
+    print "%-14s %2d pages  legacy %8.4fs  lxml %8.4fs  speedup %.2fx" % \
+          (name,len(pages),legacy_time,lxml_time,legacy_time / lxml_time)
+
+def main():
+    iterations = 100
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    pages = []
+    for page_file in sorted(glob.glob(os.path.join(TOP_DIR,'testdata','mailarchive','msg0635*.html'))):
+        pages.append(open(page_file).read())
+
+    run_benchmark("testdata",pages,iterations)
+    run_benchmark("md5",[md5_page()],iterations)
+    for package_count in (100,1000,10000):
+        run_benchmark("synthetic %d" % package_count,[synthetic_page(package_count)],max(1,iterations * 10 / package_count))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+# Micro-benchmark for MessageParser.processPackageList
+#
+# Compares the single pass scanner in centos-errata.py against the
+# previous line by line implementation, using the message bodies found
+# in the bundled testdata/digest and testdata/archive inputs. A large
+# synthetic advisory (hundreds of RPMs per architecture, similar to a
+# kernel or openoffice update) is also timed.
+#
+# Usage: python benchmarks/bench_package_list.py [iterations]
+
+import imp
+import mailbox
+import os
+import re
+import sys
+import timeit
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ce = imp.load_source('centos_errata',os.path.join(TOP_DIR,'centos-errata.py'))
+
+#The implementation processPackageList used before the single pass scanner
+ARCH_SPLIT="(?P<arch>\w+):\s*$"
+PACKAGE_LIST="(?P<checksum>\S+)\s+(?P<pkg_filename>[\.\w-]+.rpm)"
+arch_re = re.compile(ARCH_SPLIT)
+packagelist_re = re.compile(PACKAGE_LIST)
+
+def legacy_process_package_list(message_body):
+    arch_packages={}
+
+    current_arch = None
+
+    for line in message_body.split('\n'):
+        arch_match = arch_re.match(line)
+        packagelist_match = packagelist_re.match(line)
+
+        if not arch_match is None:
+            current_arch = arch_match.group('arch')
+            arch_packages[current_arch]=list()
+        elif not (current_arch is None or
+                  packagelist_match is None):
+            arch_packages[current_arch].append(
+                ce.MessagePackageInfo(
+                current_arch,
+                packagelist_match.group('checksum'),
+                packagelist_match.group('pkg_filename')
+                )
+                )
+
+    return arch_packages
+
+#Gather the text parts of every message in the mbox files of a directory
+def load_bodies(data_dir):
+    bodies = []
+    for filename in sorted(os.listdir(data_dir)):
+        for message in mailbox.mbox(os.path.join(data_dir,filename)):
+            for part in message.walk():
+                if part.is_multipart():
+                    continue
+                payload = part.get_payload(decode=True)
+                if payload:
+                    bodies.append(payload)
+    return bodies
+
+#Build an advisory body listing package_count packages per architecture
+def synthetic_body(package_count):
+    lines = ["CentOS Errata and Security Advisory 2012:0000 Important",""]
+    for arch in ("i386","x86_64"):
+        lines.append("%s:" % arch)
+        for i in range(package_count):
+            lines.append("%032x  kernel-module-%d-2.6.18-308.el5.%s.rpm" % (i,i,arch))
+        lines.append("")
+    lines.append("Source:")
+    lines.append("%032x  kernel-2.6.18-308.el5.src.rpm" % 0)
+    return "\n".join(lines)
+
+def package_tuples(arch_packages):
+    result = {}
+    for arch, packages in arch_packages.items():
+        result[arch] = [(p.architecture,p.checksum,p.filename) for p in packages]
+    return result
+
+def run_benchmark(name,bodies,iterations):
+    parser = ce.MessageParser(None)
+
+    for body in bodies:
+        if package_tuples(parser.processPackageList(body)) != \
+               package_tuples(legacy_process_package_list(body)):
+            print "%s: results differ between implementations" % name
+            sys.exit(1)
+
+    def run_legacy():
+        for body in bodies:
+            legacy_process_package_list(body)
+
+    def run_scan():
+        for body in bodies:
+            parser.processPackageList(body)
+
+    legacy_time = min(timeit.repeat(run_legacy,repeat=3,number=iterations))
+    scan_time = min(timeit.repeat(run_scan,repeat=3,number=iterations))
+
+    print "%-10s %3d bodies  legacy %8.4fs  single pass %8.4fs  speedup %.2fx" % \
+          (name,len(bodies),legacy_time,scan_time,legacy_time / scan_time)
+
+def main():
+    iterations = 200
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    testdata = os.path.join(TOP_DIR,'testdata')
+    run_benchmark("digest",load_bodies(os.path.join(testdata,'digest')),iterations)
+    run_benchmark("archive",load_bodies(os.path.join(testdata,'archive')),iterations)
+    run_benchmark("synthetic",[synthetic_body(500)],max(1,iterations / 10))
+
+if __name__ == "__main__":
+    main()
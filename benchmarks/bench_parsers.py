@@ -0,0 +1,316 @@
+#!/usr/bin/python
+
+# Throughput benchmark for the message parsers
+#
+# Generates synthetic centos-announce corpora of any size, mixing CESA,
+# CEBA and CEEA advisories for several CentOS versions and many
+# architectures, in each of the input formats: a digest, an mbox archive
+# and a mail-archive.com tree read over file://. Each parser is run in a
+# child process over each corpus and the messages per second and peak
+# memory are reported.
+#
+# Results are printed one JSON object per line so they can be collected
+# and compared between runs, e.g.
+#
+#   python benchmarks/bench_parsers.py --messages 10000,100000 > results.json
+#
+# Usage: python benchmarks/bench_parsers.py [options]
+
+from optparse import OptionParser, SUPPRESS_HELP
+import imp
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORMATS = ["digest","archive","mail-archive.com"]
+
+ADVISORY_TYPES = [("CESA","Security",["Critical","Important","Moderate","Low"]),
+                  ("CEBA","Bugfix",[None]),
+                  ("CEEA","Enhancement",[None])]
+CENTOS_VERSIONS = ["4","5","6"]
+ARCHES = ["i386","x86_64","ia64","ppc","s390","s390x","alpha","sparc"]
+PACKAGES = ["krb5","kernel","openoffice.org","bind","vsftpd","openssl","httpd",
+            "php","samba","firefox","thunderbird","glibc","postgresql","mysql"]
+MONTHS = ["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
+DAYS = ["Mon","Tue","Wed","Thu","Fri","Sat","Sun"]
+
+#A single generated advisory
+class Advisory:
+
+    def __init__(self,index,rng):
+        (self.errataType,self.typeName,severities) = rng.choice(ADVISORY_TYPES)
+        self.severity = rng.choice(severities)
+        self.year = 2005 + index / 2000
+        self.errataId = index % 2000
+        self.version = rng.choice(CENTOS_VERSIONS)
+        self.package = rng.choice(PACKAGES)
+        self.release = "%d.el%s_%d" % (rng.randint(1,90),self.version,rng.randint(0,9))
+        self.day = rng.randint(1,28)
+        self.month = rng.randint(0,11)
+        self.time = "%02d:%02d:%02d" % (rng.randint(0,23),rng.randint(0,59),rng.randint(0,59))
+
+        #Most advisories list a few packages, kernel and openoffice
+        #style ones list many
+        if self.package in ("kernel","openoffice.org"):
+            package_count = rng.randint(20,60)
+        else:
+            package_count = rng.randint(1,8)
+
+        self.packagesByArch = []
+        for arch in rng.sample(ARCHES,rng.randint(1,4)) + ["Source"]:
+            packages = []
+            for package_index in range(package_count):
+                if arch == "Source":
+                    filename = "%s-%d.%s.src.rpm" % (self.package,package_index,self.release)
+                else:
+                    filename = "%s-sub%d-1.0-%s.%s.rpm" % (self.package,package_index,self.release,arch)
+                packages.append(("%064x" % rng.getrandbits(256),filename))
+                if arch == "Source":
+                    break
+            self.packagesByArch.append((arch,packages))
+
+    def getSubject(self):
+        if self.severity is not None:
+            return "[CentOS-announce] %s-%d:%04d %s CentOS %s %s Update" % (
+                self.errataType,self.year,self.errataId,self.severity,self.version,self.package)
+        return "[CentOS-announce] %s-%d:%04d CentOS %s %s Update" % (
+            self.errataType,self.year,self.errataId,self.version,self.package)
+
+    def getDate(self):
+        return "%s, %d %s %d %s +0000" % (DAYS[self.day % 7],self.day,MONTHS[self.month],self.year,self.time)
+
+    def getEnvelopeDate(self):
+        return "%s %s %2d %s %d" % (DAYS[self.day % 7],MONTHS[self.month],self.day,self.time,self.year)
+
+    #The body as posted, separator is put between checksum and filename
+    def getBody(self,separator="  "):
+        lines = ["",
+                 "CentOS Errata and %s Advisory %d:%04d %s" % (self.typeName,self.year,self.errataId,self.severity or ""),
+                 "",
+                 "Upstream details at : https://rhn.redhat.com/errata/RH%s-%d-%04d.html" % (self.errataType[2:],self.year,self.errataId),
+                 "",
+                 "The following updated files have been uploaded and are currently ",
+                 "syncing to the mirrors: ( sha256sum Filename ) ",
+                 ""]
+        for (arch,packages) in self.packagesByArch:
+            lines.append("%s:" % arch)
+            for (checksum,filename) in packages:
+                lines.append("%s%s%s" % (checksum,separator,filename))
+            lines.append("")
+        lines.extend(["","","-- ","Johnny Hughes","CentOS Project { http://www.centos.org/ }",""])
+        return "\n".join(lines)
+
+def generate_advisories(count,seed):
+    rng = random.Random(seed)
+    for index in xrange(count):
+        yield Advisory(index,rng)
+
+def write_archive(path,advisories):
+    archive_f = open(path,"w")
+    for advisory in advisories:
+        archive_f.write("From johnny at centos.org  %s\n" % advisory.getEnvelopeDate())
+        archive_f.write("From: johnny at centos.org (Johnny Hughes)\n")
+        archive_f.write("Date: %s\n" % advisory.getDate())
+        archive_f.write("Subject: %s\n" % advisory.getSubject())
+        archive_f.write("Message-ID: <%d.%d@centos.org>\n\n" % (advisory.year,advisory.errataId))
+        archive_f.write(advisory.getBody())
+        archive_f.write("\n\n")
+    archive_f.close()
+
+def write_digest(path,advisories):
+    digest_f = open(path,"w")
+    digest_f.write("From centos-announce-bounces@centos.org Wed Dec 28 17:01:51 2011\n")
+    digest_f.write("From: centos-announce-request@centos.org\n")
+    digest_f.write("Subject: CentOS-announce Digest, Vol 1, Issue 1\n")
+    digest_f.write("To: centos-announce@centos.org\n")
+    digest_f.write("Date: Wed, 28 Dec 2011 12:00:03 -0500\n")
+    digest_f.write("MIME-Version: 1.0\n")
+    digest_f.write("Content-Type: text/plain; charset=\"us-ascii\"\n\n")
+    digest_f.write("Send CentOS-announce mailing list submissions to\n\tcentos-announce@centos.org\n\n")
+    digest_f.write("-" * 70 + "\n\n")
+    message_number = 0
+    for advisory in advisories:
+        message_number += 1
+        if message_number > 1:
+            digest_f.write("------------------------------\n\n")
+        digest_f.write("Message: %d\n" % message_number)
+        digest_f.write("Date: %s\n" % advisory.getDate())
+        digest_f.write("From: Johnny Hughes <johnny@centos.org>\n")
+        digest_f.write("Subject: %s\n" % advisory.getSubject())
+        digest_f.write("To: centos-announce@centos.org\n")
+        digest_f.write("Content-Type: text/plain; charset=us-ascii\n\n")
+        digest_f.write(advisory.getBody())
+        digest_f.write("\n\n")
+    digest_f.write("------------------------------\n\n")
+    digest_f.write("End of CentOS-announce Digest, Vol 1, Issue 1\n")
+    digest_f.close()
+
+MAILARCHIVE_PAGE = """<html>
+<head>
+  <title>%(subject)s</title>
+</head>
+<body>
+<div class="msgHead">
+<h1><span class="subject">%(subject)s</span></h1>
+<p class="darkgray font13"><span class="sender">Johnny Hughes</span>
+<span class="date">%(date)s</span></p>
+</div>
+<div class="msgBody">
+<!--X-Body-of-Message-->
+<pre>
+%(body)s
+</pre>
+<!--X-Body-of-Message-End-->
+</div>
+</body>
+</html>
+"""
+
+#Write maillist.html and a page per message. Messages are listed
+#newest first, as on mail-archive.com
+def write_mailarchive(path,advisories):
+    os.mkdir(path)
+    entries = []
+    for (index,advisory) in enumerate(advisories):
+        relurl = "msg%07d.html" % index
+        page_f = open(os.path.join(path,relurl),"w")
+        page_f.write(MAILARCHIVE_PAGE % {'subject': advisory.getSubject(),
+                                         'date': advisory.getDate(),
+                                         'body': advisory.getBody("  \n")})
+        page_f.close()
+        entries.append("<span class=\"subject\"><a name=\"%07d\" href=\"%s\">%s</a></span>" % (index,relurl,advisory.getSubject()))
+
+    entries.reverse()
+    index_f = open(os.path.join(path,"maillist.html"),"w")
+    index_f.write("<html><body>\n<ul>\n")
+    for entry in entries:
+        index_f.write("<li>\n%s\n</li>\n" % entry)
+    index_f.write("</ul>\n</body></html>\n")
+    index_f.close()
+
+def write_corpus(work_dir,parse_format,count,seed):
+    advisories = generate_advisories(count,seed)
+    if parse_format == "digest":
+        path = os.path.join(work_dir,"digest-%d.txt" % count)
+        write_digest(path,advisories)
+    elif parse_format == "archive":
+        path = os.path.join(work_dir,"archive-%d.txt" % count)
+        write_archive(path,advisories)
+    else:
+        path = os.path.join(work_dir,"mailarchive-%d" % count)
+        write_mailarchive(path,advisories)
+    return path
+
+#Options read by the parsers
+class ParserOptions:
+
+    def __init__(self,centos_version):
+        self.centos_version = centos_version
+        self.testmode = False
+        self.max_errata = sys.maxint
+        self.fetch_workers = 4
+        self.fetch_timeout = 30
+        self.page_cache = None
+
+#Run one parser over one corpus and print the result as JSON. Run in a
+#child process so the peak memory is that of this parser alone
+def measure(parse_format,path,centos_version):
+    ce = imp.load_source('centos_errata',os.path.join(TOP_DIR,'centos-errata.py'))
+    options = ParserOptions(centos_version)
+
+    if parse_format == "digest":
+        parser = ce.MessageDigest(options,path)
+    elif parse_format == "archive":
+        parser = ce.MessageArchiveFile(options,path)
+    else:
+        ce.MessageMailArchive.MAILARCHIVE_BASE = "file://%s/" % os.path.abspath(path)
+        parser = ce.MessageMailArchive(options)
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    #The parsers report progress on stdout
+    result_f = os.fdopen(os.dup(sys.stdout.fileno()),"w")
+    devnull_f = open(os.devnull,"w")
+    os.dup2(devnull_f.fileno(),sys.stdout.fileno())
+
+    parsed_count = 0
+    package_count = 0
+    start = time.time()
+    for parsed_msg in parser.iterParse():
+        parsed_count += 1
+        for packages in parsed_msg.packageByArch.values():
+            package_count += len(packages)
+    elapsed = time.time() - start
+
+    sys.stdout.flush()
+    result_f.write(json.dumps({'parsed_messages': parsed_count,
+                               'parsed_packages': package_count,
+                               'seconds': elapsed,
+                               'baseline_rss_kb': baseline_kb,
+                               'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}) + "\n")
+    result_f.close()
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("","--messages",type="string",dest="messages",default="10000",
+                      help="Comma separated corpus sizes in messages. Default is 10000")
+    parser.add_option("","--formats",type="string",dest="formats",default=",".join(FORMATS),
+                      help="Comma separated formats to benchmark. Default is %s" % ",".join(FORMATS))
+    parser.add_option("","--centos-version",type="string",dest="centos_version",default="5",
+                      help="CentOS version the parsers look for. Default is 5")
+    parser.add_option("","--seed",type="int",dest="seed",default=1,
+                      help="Seed for the corpus generator. Default is 1")
+    parser.add_option("","--work-dir",type="string",dest="work_dir",
+                      help="Write the corpora here and keep them. By default a temporary directory is used and removed")
+    parser.add_option("","--measure",type="string",dest="measure",
+                      help=SUPPRESS_HELP)
+    (options,args) = parser.parse_args()
+
+    if options.measure is not None:
+        measure(options.measure,args[0],options.centos_version)
+        return
+
+    work_dir = options.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="centos-errata-bench-")
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        for count in [int(count) for count in options.messages.split(",")]:
+            for parse_format in options.formats.split(","):
+                generate_start = time.time()
+                path = write_corpus(work_dir,parse_format,count,options.seed)
+                generate_time = time.time() - generate_start
+
+                child = subprocess.Popen([sys.executable,os.path.abspath(__file__),
+                                          "--measure",parse_format,
+                                          "--centos-version",options.centos_version,
+                                          path],
+                                         stdout=subprocess.PIPE)
+                output = child.communicate()[0]
+                if child.returncode != 0:
+                    print >>sys.stderr, "Benchmark of %s with %d messages failed" % (parse_format,count)
+                    sys.exit(1)
+
+                result = json.loads(output.strip().split("\n")[-1])
+                result.update({'format': parse_format,
+                               'messages': count,
+                               'messages_per_second': count / max(result['seconds'],1e-9),
+                               'generate_seconds': generate_time})
+                print json.dumps(result,sort_keys=True)
+                sys.stdout.flush()
+    finally:
+        if options.work_dir is None:
+            shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+
+# End-to-end benchmark of publishing errata to a Spacewalk server
+#
+# Runs centos-errata.py against the local stand-in in
+# benchmarks/mock_spacewalk.py, so the whole path from reading an
+# announcement archive to creating errata is exercised, including the
+# server checks that --test skips. The corpus is generated with
+# benchmarks/bench_parsers.py and a synthetic RPM is written for every
+# binary package it lists, so the 'dir' search strategy finds them all.
+#
+# The mock server is seeded so that every code path is used: most
+# packages are in the channel listings, the rest have to be looked up
+# with packages.findByNvrea, and some errata already exist on the server
+# without being listed in their channel, so errata.getDetails reports
+# them. The server is reset before each run. A latency can be injected to
+# see how the run time depends on the round trip time to the server, and
+# a short session lifetime makes the script log in again.
+#
+# For each number of publishing workers the wall time, the calls seen by
+# the server and the phase times the script reports with --stats are
+# printed as one JSON object per line, e.g.
+#
+#   python benchmarks/bench_publish.py --messages 3000 --workers 1,4 --latency 0.02
+#
+# Usage: python benchmarks/bench_publish.py [options]
+
+from optparse import OptionParser
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import bench_parsers
+import mock_spacewalk
+
+TOP_DIR = bench_parsers.TOP_DIR
+
+#Architectures configured for the run, and their channels
+BENCH_ARCHES = ["i386","x86_64"]
+
+def channel_label(arch):
+    return "centos-%s-updates" % arch
+
+#Build an RPM header structure holding the (tag,type,value) entries.
+#Only the INT32 and STRING types are needed
+def rpm_header(entries,pad=False):
+    index = ""
+    store = ""
+    for (tag,tag_type,value) in entries:
+        if tag_type == 4:
+            store += "\0" * ((4 - len(store) % 4) % 4)
+            offset = len(store)
+            store += struct.pack(">i",value)
+        else:
+            offset = len(store)
+            store += value + "\0"
+        index += struct.pack(">IIII",tag,tag_type,offset,1)
+
+    header = "\x8e\xad\xe8\x01" + "\0" * 4 + struct.pack(">II",len(entries),len(store)) + index + store
+    if pad:
+        header += "\0" * ((8 - len(header) % 8) % 8)
+    return header
+
+#Write a minimal RPM whose header carries only the NVREA. It is only
+#good enough for the lean RPM reader
+def write_rpm(path,name,version,release,epoch,arch):
+    lead = "\xed\xab\xee\xdb" + "\x03\x00" + "\0" * 90
+    signature = rpm_header([(1000,4,len(name)),(1004,6,"benchmark")],pad=True)
+    entries = [(1000,6,name),(1001,6,version),(1002,6,release)]
+    if epoch is not None:
+        entries.append((1003,4,epoch))
+    entries.append((1022,6,arch))
+
+    rpm_f = open(path,"wb")
+    rpm_f.write(lead + signature + rpm_header(entries))
+    rpm_f.close()
+
+#The generated filenames are name-version-release.arch.rpm with a
+#version of 1.0, see bench_parsers.Advisory
+def split_filename(filename):
+    (name_version_release,arch) = filename[:-len(".rpm")].rsplit(".",1)
+    (name,release) = name_version_release.split("-1.0-",1)
+    return (name,"1.0",release,None,arch)
+
+def advisory_name(advisory):
+    return "%s-%d:%04d" % (advisory.errataType,advisory.year,advisory.errataId)
+
+#Write the archive and packages into work_dir and seed the mock server.
+#Returns (archive path,number of errata the script will handle)
+def prepare_corpus(work_dir,mock,options):
+    archive_path = os.path.join(work_dir,"archive-%d.txt" % options.messages)
+    bench_parsers.write_archive(archive_path,bench_parsers.generate_advisories(options.messages,options.seed))
+
+    rng = random.Random(options.seed)
+    seen_packages = set()
+    errata_count = 0
+    for advisory in bench_parsers.generate_advisories(options.messages,options.seed):
+        if advisory.version != options.centos_version:
+            continue
+
+        advisory_arches = [arch for (arch,packages) in advisory.packagesByArch if arch in BENCH_ARCHES]
+        if len(advisory_arches) == 0:
+            continue
+        errata_count += 1
+
+        if rng.random() < options.existing:
+            mock.addErratum(advisory_name(advisory),[channel_label(arch) for arch in advisory_arches],listed=False)
+
+        for (arch,packages) in advisory.packagesByArch:
+            if arch not in BENCH_ARCHES:
+                continue
+            package_dir = os.path.join(work_dir,arch)
+            for (checksum,filename) in packages:
+                if filename in seen_packages:
+                    continue
+                seen_packages.add(filename)
+
+                (name,version,release,epoch,pkg_arch) = split_filename(filename)
+                write_rpm(os.path.join(package_dir,filename),name,version,release,epoch,pkg_arch)
+                mock.addPackage([channel_label(arch)],name,version,release,epoch,pkg_arch,checksum,
+                                listed=rng.random() >= options.unlisted)
+
+    return (archive_path,errata_count)
+
+def write_config(path,work_dir,port,centos_version):
+    config_f = open(path,"w")
+    config_f.write("[centos errata]\n")
+    config_f.write("version=%s\n" % centos_version)
+    config_f.write("release=0\n")
+    config_f.write("search_strategies=dir\n")
+    config_f.write("scrape_rhn=False\n\n")
+    config_f.write("[spacewalk]\n")
+    config_f.write("server=127.0.0.1:%d\n" % port)
+    config_f.write("login=benchmark\n")
+    config_f.write("password=benchmark\n\n")
+    for arch in BENCH_ARCHES:
+        config_f.write("[%s]\n" % arch)
+        config_f.write("package_dir=%s/\n" % os.path.join(work_dir,arch))
+        config_f.write("channel=%s\n\n" % channel_label(arch))
+    config_f.close()
+
+#Run centos-errata.py once. Returns the wall time in seconds and the
+#report the script wrote with --stats
+def run_script(config_path,archive_path,workers,log_path,stats_path):
+    env = dict(os.environ)
+    env["PYTHONHTTPSVERIFY"] = "0"
+
+    log_f = open(log_path,"w")
+    start = time.time()
+    try:
+        #The script reads centos-errata.cfg from the current directory
+        returncode = subprocess.call([sys.executable,os.path.join(TOP_DIR,"centos-errata.py"),
+                                      "-c",config_path,
+                                      "-f","archive",
+                                      "--lean-rpm-reader",
+                                      "--workers",str(workers),
+                                      "--stats",stats_path,
+                                      archive_path],
+                                     cwd=TOP_DIR,env=env,stdout=log_f,stderr=subprocess.STDOUT)
+    finally:
+        log_f.close()
+    elapsed = time.time() - start
+
+    if returncode != 0:
+        print >> sys.stderr, "centos-errata.py failed with exit code %d, see %s" % (returncode,log_path)
+        sys.exit(1)
+
+    stats_f = open(stats_path)
+    try:
+        return (elapsed,json.load(stats_f))
+    finally:
+        stats_f.close()
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("","--messages",type="int",dest="messages",default=1000,
+                      help="Number of messages in the generated archive. Default is 1000")
+    parser.add_option("","--workers",type="string",dest="workers",default="1,4",
+                      help="Comma separated numbers of publishing workers to run with. Default is 1,4")
+    parser.add_option("","--centos-version",type="string",dest="centos_version",default="5",
+                      help="CentOS version the script is configured for. Default is 5")
+    parser.add_option("","--existing",type="float",dest="existing",default=0.1,
+                      help="Fraction of errata already on the server but not in the channel listing. Default is 0.1")
+    parser.add_option("","--unlisted",type="float",dest="unlisted",default=0.1,
+                      help="Fraction of packages missing from the channel listing. Default is 0.1")
+    parser.add_option("","--seed",type="int",dest="seed",default=1,
+                      help="Seed for the corpus generator. Default is 1")
+    parser.add_option("","--work-dir",type="string",dest="work_dir",
+                      help="Write the corpus, config and logs here and keep them. By default a temporary directory is used and removed")
+    mock_spacewalk.add_server_options(parser)
+    (options,args) = parser.parse_args()
+
+    work_dir = options.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="centos-errata-bench-")
+    for arch in BENCH_ARCHES:
+        if not os.path.isdir(os.path.join(work_dir,arch)):
+            os.makedirs(os.path.join(work_dir,arch))
+
+    (server,cert_dir) = mock_spacewalk.start_server(options)
+    try:
+        (archive_path,errata_count) = prepare_corpus(work_dir,server.mock,options)
+        config_path = os.path.join(work_dir,"bench-publish.cfg")
+        write_config(config_path,work_dir,server.getPort(),options.centos_version)
+
+        for workers in [int(workers) for workers in options.workers.split(",")]:
+            server.mock.reset()
+            log_path = os.path.join(work_dir,"run-%d-workers.log" % workers)
+            stats_path = os.path.join(work_dir,"run-%d-workers.json" % workers)
+            (elapsed,script_stats) = run_script(config_path,archive_path,workers,log_path,stats_path)
+
+            result = {'messages': options.messages,
+                      'errata': errata_count,
+                      'workers': workers,
+                      'latency': options.latency,
+                      'session_lifetime': options.session_lifetime,
+                      'seconds': elapsed,
+                      'script_phases': script_stats['phases']}
+            result.update(server.mock.getStats())
+            print json.dumps(result,sort_keys=True)
+            sys.stdout.flush()
+    finally:
+        server.shutdown()
+        if cert_dir is not None:
+            shutil.rmtree(cert_dir)
+        if options.work_dir is None:
+            shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
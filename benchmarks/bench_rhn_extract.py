@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+# Benchmark for the extraction of errata details from RHN pages
+#
+# Compares extract_description in centos-errata.py, which parses each
+# page once with lxml, against the previous regular expression
+# extraction. Synthetic RHN errata pages of increasing size are used,
+# the size coming from the updated packages table as it does for large
+# advisories such as kernel updates. Both implementations must produce
+# the same text.
+#
+# Usage: python benchmarks/bench_rhn_extract.py [iterations]
+
+import imp
+import os
+import re
+import sys
+import timeit
+
+import lxml.html
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ce = imp.load_source('centos_errata',os.path.join(TOP_DIR,'centos-errata.py'))
+
+#The extraction used before the lxml version
+RHN_ERRATA_DETAILS="<h2>Details</h2>(\s+)<div class=\"page-summary\">(?P<details>[\w\W\s]+)</div>(\s+)<br />(\s+)<h2>Solution</h2>"
+RHN_ERRATA_SOLUTION="<h2>Solution</h2>(\s+)<div class=\"page-summary\">(?P<solution>[\w\W\s]+)</div>(\s+)<br />(\s+)<h2>Updated packages</h2>"
+rhn_details_re = re.compile(RHN_ERRATA_DETAILS)
+rhn_solution_re = re.compile(RHN_ERRATA_SOLUTION)
+
+def legacy_replace_rhn_content(rhn_content):
+    parsed_xml = lxml.html.fromstring(rhn_content.replace("<br />","\n"))
+
+    for para in parsed_xml.xpath("*//p"):
+        para.text = "\n%s\n" % para.text
+
+    ret = parsed_xml.text_content()
+    return ret.replace("Red Hat Enterprise Linux", "CentOS")
+
+def legacy_extract_description(message_src):
+    description = None
+    solution = None
+
+    details_match = rhn_details_re.search(message_src)
+    if not details_match is None:
+        description = legacy_replace_rhn_content(details_match.group("details"))
+
+    solution_match = rhn_solution_re.search(message_src)
+    if not solution_match is None:
+        solution = legacy_replace_rhn_content(solution_match.group("solution"))
+
+    return (description,solution)
+
+DETAILS_BODIES = [
+    "\n<p>Updated kernel packages that fix several security issues are now available for Red Hat Enterprise Linux 5.</p><p>The kernel packages contain the Linux kernel.</p>\n",
+    "<p>A single paragraph for Red Hat Enterprise Linux 6.</p>",
+    "\nUpdated packages are available.<br />\n<br />\nThis update fixes <a href=\"https://bugzilla.redhat.com/\">several bugs</a> &amp; issues.<br />\n",
+    "\n<div><p>Nested paragraph one.</p><p>Nested paragraph two.</p></div>\n",
+]
+
+SOLUTION_BODY = "\n<p>Before applying this update, make sure all previously-released errata relevant to your system have been applied.</p><p>This update is available via the Red Hat Network.</p>\n"
+
+#Build an RHN errata page whose updated packages table has package_rows rows
+def rhn_page(details_body,package_rows):
+    rows = []
+    for i in range(package_rows):
+        rows.append("<tr><td class=\"name\">kernel-module-%d-2.6.18-308.el5.x86_64.rpm</td><td class=\"checksum\">%064x</td></tr>" % (i,i))
+    return "\n".join([
+        "<html><head><title>RHSA-2012:0007</title></head><body>",
+        "<div id=\"nav\"><ul><li><a href=\"/\">Home</a></li></ul></div>",
+        "<h1>Important: kernel security update</h1>",
+        "<h2>Details</h2>",
+        "<div class=\"page-summary\">%s</div>" % details_body,
+        "<br />",
+        "<h2>Solution</h2>",
+        "<div class=\"page-summary\">%s</div>" % SOLUTION_BODY,
+        "<br />",
+        "<h2>Updated packages</h2>",
+        "<table class=\"details\">",
+        "\n".join(rows),
+        "</table>",
+        "<h2>References</h2><div class=\"page-summary\"><p>https://www.redhat.com/security/</p></div>",
+        "</body></html>"])
+
+def check_results():
+    for details_body in DETAILS_BODIES:
+        page = rhn_page(details_body,10)
+        if ce.extract_description(page) != legacy_extract_description(page):
+            print "Results differ between implementations for details %r" % details_body
+            print ce.extract_description(page)
+            print legacy_extract_description(page)
+            sys.exit(1)
+
+def main():
+    iterations = 20
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    check_results()
+
+    print "%8s %8s %14s %14s %14s" % ("rows","KB","regex ms","lxml ms","lxml us/KB")
+    for package_rows in (10,100,1000,5000,20000):
+        page = rhn_page(DETAILS_BODIES[0],package_rows)
+        page_kb = len(page) / 1024.0
+        number = max(1,iterations * 100 / package_rows)
+
+        legacy_time = min(timeit.repeat(lambda: legacy_extract_description(page),repeat=3,number=number)) / number
+        lxml_time = min(timeit.repeat(lambda: ce.extract_description(page),repeat=3,number=number)) / number
+
+        print "%8d %8.0f %14.2f %14.2f %14.2f" % \
+              (package_rows,page_kb,legacy_time * 1000,lxml_time * 1000,lxml_time * 1000000 / page_kb)
+
+if __name__ == "__main__":
+    main()
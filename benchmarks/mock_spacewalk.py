@@ -0,0 +1,454 @@
+#!/usr/bin/python
+
+# Local stand-in for the Spacewalk XML-RPC API
+#
+# Implements the subset of the API used by RHNSession in
+# centos-errata.py so the publishing path can be run and timed without a
+# real server: auth.login/logout, errata.getDetails/create,
+# packages.findByNvrea, packages.search.name, packages.getDetails,
+# channel.software.listErrata/listAllPackages and system.multicall.
+#
+# Faults are raised as a Spacewalk server would: -20 when the session key
+# is unknown or has expired and -208 when errata.getDetails is asked
+# about an erratum that does not exist. A latency can be added to every
+# HTTP request and to individual methods, and every request, connection,
+# method call and fault is counted.
+#
+# The server speaks HTTPS on /rpc/api as RHNSession always uses https. A
+# self-signed certificate is generated with openssl unless one is given,
+# so clients must be run with PYTHONHTTPSVERIFY=0.
+#
+# It is normally started from benchmarks/bench_publish.py but can be run
+# on its own, e.g.
+#
+#   python benchmarks/mock_spacewalk.py --port 8443 --latency 0.05
+#
+# Usage: python benchmarks/mock_spacewalk.py [options]
+
+from optparse import OptionParser
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+#Fault codes returned by Spacewalk
+SESSION_EXPIRED_FAULT=-20
+NO_SUCH_ERRATUM_FAULT=-208
+
+#Server side state and the implementation of the API methods. Methods
+#taking a session key check it first
+class MockSpacewalk:
+
+    def __init__(self,latency=0.0,method_latency=None,session_lifetime=None):
+        self.latency = latency
+        self.methodLatency = method_latency or {}
+        self.sessionLifetime = session_lifetime
+        self.lock = threading.Lock()
+
+        #What the server holds before any errata are created, restored by reset()
+        self.seedPackages = []
+        self.seedErrata = []
+
+        self.methods = {"auth.login": self.login,
+                        "auth.logout": self.logout,
+                        "errata.getDetails": self.getErrataDetails,
+                        "errata.create": self.createErrata,
+                        "packages.findByNvrea": self.findByNvrea,
+                        "packages.search.name": self.searchName,
+                        "packages.getDetails": self.getPackageDetails,
+                        "channel.software.listErrata": self.listChannelErrata,
+                        "channel.software.listAllPackages": self.listChannelPackages}
+        self.reset()
+
+    #Forget created errata, session keys and counters
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.sessionKeys = {}
+            self.packages = {}
+            self.packagesByNvrea = {}
+            self.channelPackages = {}
+            self.errata = {}
+            self.channelErrata = {}
+            self.resetStats()
+
+            for (channel_labels,name,version,release,epoch,arch,checksum,listed) in self.seedPackages:
+                self.storePackage(channel_labels,name,version,release,epoch,arch,checksum,listed)
+            for (advisory_name,channel_labels,listed) in self.seedErrata:
+                self.storeErratum(advisory_name,{'synopsis': advisory_name},[],channel_labels,listed)
+        finally:
+            self.lock.release()
+
+    def resetStats(self):
+        self.requestCount = 0
+        self.connectionCount = 0
+        self.loginCount = 0
+        self.calls = {}
+        self.faults = {}
+
+    def getStats(self):
+        self.lock.acquire()
+        try:
+            return {'http_requests': self.requestCount,
+                    'connections': self.connectionCount,
+                    'logins': self.loginCount,
+                    'calls': dict(self.calls),
+                    'faults': dict(self.faults),
+                    'errata_created': len(self.errata) - len(self.seedErrata)}
+        finally:
+            self.lock.release()
+
+    #Add a package to the server. Packages which are not listed are in
+    #the channel but left out of channel.software.listAllPackages, so
+    #clients have to look them up with packages.findByNvrea
+    def addPackage(self,channel_labels,name,version,release,epoch,arch,checksum="",listed=True):
+        self.seedPackages.append((channel_labels,name,version,release,epoch,arch,checksum,listed))
+        self.lock.acquire()
+        try:
+            self.storePackage(channel_labels,name,version,release,epoch,arch,checksum,listed)
+        finally:
+            self.lock.release()
+
+    #Add an erratum to the server. Errata which are not listed are left
+    #out of channel.software.listErrata, so clients have to ask about
+    #them with errata.getDetails
+    def addErratum(self,advisory_name,channel_labels,listed=True):
+        self.seedErrata.append((advisory_name,channel_labels,listed))
+        self.lock.acquire()
+        try:
+            self.storeErratum(advisory_name,{'synopsis': advisory_name},[],channel_labels,listed)
+        finally:
+            self.lock.release()
+
+    def storePackage(self,channel_labels,name,version,release,epoch,arch,checksum,listed):
+        if epoch is None:
+            epoch = ""
+        nvrea = (name,version,release,str(epoch),arch)
+        if self.packagesByNvrea.has_key(nvrea):
+            pkg = self.packagesByNvrea[nvrea]
+        else:
+            pkg = {'id': len(self.packages) + 1,
+                   'name': name,
+                   'version': version,
+                   'release': release,
+                   'epoch': str(epoch),
+                   'arch_label': arch,
+                   'checksum': checksum,
+                   'path': "redhat/1/%s/%s/%s-%s/%s/%s-%s-%s.%s.rpm" % (name,version,release,epoch,arch,name,version,release,arch),
+                   'provider': "CentOS",
+                   'last_modified': "2012-01-01 00:00:00"}
+            self.packages[pkg['id']] = pkg
+            self.packagesByNvrea[nvrea] = pkg
+
+        if listed:
+            for channel_label in channel_labels:
+                self.channelPackages.setdefault(channel_label,[]).append(pkg['id'])
+
+    def storeErratum(self,advisory_name,info,package_ids,channel_labels,listed):
+        self.errata[advisory_name] = (info,package_ids)
+        if listed:
+            for channel_label in channel_labels:
+                self.channelErrata.setdefault(channel_label,[]).append(advisory_name)
+
+    #Called for every HTTP request before it is dispatched
+    def countRequest(self):
+        self.lock.acquire()
+        try:
+            self.requestCount += 1
+        finally:
+            self.lock.release()
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def countConnection(self):
+        self.lock.acquire()
+        try:
+            self.connectionCount += 1
+        finally:
+            self.lock.release()
+
+    #Called for every method call, including each call in a multicall
+    def countCall(self,method_name):
+        self.lock.acquire()
+        try:
+            self.calls[method_name] = self.calls.get(method_name,0) + 1
+        finally:
+            self.lock.release()
+        if self.methodLatency.has_key(method_name):
+            time.sleep(self.methodLatency[method_name])
+
+    def countFault(self,fault_code):
+        self.lock.acquire()
+        try:
+            self.faults[str(fault_code)] = self.faults.get(str(fault_code),0) + 1
+        finally:
+            self.lock.release()
+
+    def checkSession(self,session_key):
+        self.lock.acquire()
+        try:
+            login_time = self.sessionKeys.get(session_key)
+        finally:
+            self.lock.release()
+
+        if login_time is None:
+            raise xmlrpclib.Fault(SESSION_EXPIRED_FAULT,"Could not find session")
+        if self.sessionLifetime is not None and time.time() - login_time > self.sessionLifetime:
+            raise xmlrpclib.Fault(SESSION_EXPIRED_FAULT,"Session has expired")
+
+    def login(self,login,password,duration=None):
+        self.lock.acquire()
+        try:
+            self.loginCount += 1
+            session_key = "%dx%032x" % (self.loginCount,hash((login,password,time.time())) & 0xffffffffffffffff)
+            self.sessionKeys[session_key] = time.time()
+            return session_key
+        finally:
+            self.lock.release()
+
+    def logout(self,session_key):
+        self.checkSession(session_key)
+        self.lock.acquire()
+        try:
+            del self.sessionKeys[session_key]
+        finally:
+            self.lock.release()
+        return 1
+
+    def getErrataDetails(self,session_key,advisory_name):
+        self.checkSession(session_key)
+        self.lock.acquire()
+        try:
+            if not self.errata.has_key(advisory_name):
+                raise xmlrpclib.Fault(NO_SUCH_ERRATUM_FAULT,"The erratum %s cannot be found" % advisory_name)
+            info = self.errata[advisory_name][0]
+        finally:
+            self.lock.release()
+
+        return {'issue_date': "2012-01-01",
+                'update_date': "2012-01-01",
+                'last_modified_date': "2012-01-01 00:00:00",
+                'description': info.get('description') or "",
+                'synopsis': info.get('synopsis') or "",
+                'topic': info.get('topic') or "",
+                'references': info.get('references') or "",
+                'notes': info.get('notes') or "",
+                'type': info.get('advisory_type') or ""}
+
+    def createErrata(self,session_key,info,bugs,keywords,package_ids,publish,channel_labels):
+        self.checkSession(session_key)
+        self.lock.acquire()
+        try:
+            advisory_name = info['advisory_name']
+            if self.errata.has_key(advisory_name):
+                raise xmlrpclib.Fault(-1,"Erratum %s already exists" % advisory_name)
+            for package_id in package_ids:
+                if not self.packages.has_key(package_id):
+                    raise xmlrpclib.Fault(-1,"No package with id %s" % package_id)
+            if not publish:
+                channel_labels = []
+            self.storeErratum(advisory_name,info,package_ids,channel_labels,True)
+            return {'id': len(self.errata), 'advisory_name': advisory_name}
+        finally:
+            self.lock.release()
+
+    def findByNvrea(self,session_key,name,version,release,epoch,arch):
+        self.checkSession(session_key)
+        self.lock.acquire()
+        try:
+            pkg = self.packagesByNvrea.get((name,version,release,str(epoch),arch))
+        finally:
+            self.lock.release()
+
+        if pkg is None:
+            return []
+        return [pkg]
+
+    def searchName(self,session_key,name):
+        self.checkSession(session_key)
+        self.lock.acquire()
+        try:
+            return [pkg for pkg in self.packages.values() if pkg['name'] == name]
+        finally:
+            self.lock.release()
+
+    def getPackageDetails(self,session_key,package_id):
+        self.checkSession(session_key)
+        self.lock.acquire()
+        try:
+            if not self.packages.has_key(package_id):
+                raise xmlrpclib.Fault(-1,"No package with id %s" % package_id)
+            pkg = dict(self.packages[package_id])
+        finally:
+            self.lock.release()
+
+        pkg['last_modified_date'] = pkg['last_modified']
+        return pkg
+
+    def listChannelErrata(self,session_key,channel_label):
+        self.checkSession(session_key)
+        self.lock.acquire()
+        try:
+            return [{'advisory_name': advisory_name, 'advisory': advisory_name}
+                    for advisory_name in self.channelErrata.get(channel_label,[])]
+        finally:
+            self.lock.release()
+
+    def listChannelPackages(self,session_key,channel_label):
+        self.checkSession(session_key)
+        self.lock.acquire()
+        try:
+            return [self.packages[package_id] for package_id in self.channelPackages.get(channel_label,[])]
+        finally:
+            self.lock.release()
+
+class MockRequestHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/rpc/api',)
+    #Keep connections open between calls as the real server does
+    protocol_version = "HTTP/1.1"
+
+#Threaded XML-RPC server in front of a MockSpacewalk
+class MockSpacewalkServer(ThreadingMixIn, SimpleXMLRPCServer):
+
+    daemon_threads = True
+
+    def __init__(self,mock,port=0,certfile=None,keyfile=None):
+        SimpleXMLRPCServer.__init__(self,("127.0.0.1",port),requestHandler=MockRequestHandler,
+                                    logRequests=False,allow_none=True)
+        self.mock = mock
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.register_multicall_functions()
+
+    def getPort(self):
+        return self.server_address[1]
+
+    #The TLS handshake is left to the handler thread
+    def get_request(self):
+        (request_socket,client_address) = self.socket.accept()
+        if self.certfile is not None:
+            request_socket = ssl.wrap_socket(request_socket,server_side=True,
+                                             certfile=self.certfile,keyfile=self.keyfile,
+                                             do_handshake_on_connect=False)
+        return (request_socket,client_address)
+
+    def process_request(self,request,client_address):
+        self.mock.countConnection()
+        ThreadingMixIn.process_request(self,request,client_address)
+
+    #Clients closing their connection without a TLS shutdown are not errors
+    def handle_error(self,request,client_address):
+        if isinstance(sys.exc_info()[1],(socket.error,ssl.SSLError)):
+            return
+        SimpleXMLRPCServer.handle_error(self,request,client_address)
+
+    def _marshaled_dispatch(self,data,dispatch_method=None,path=None):
+        self.mock.countRequest()
+        return SimpleXMLRPCServer._marshaled_dispatch(self,data,dispatch_method,path)
+
+    def _dispatch(self,method_name,params):
+        self.mock.countCall(method_name)
+        try:
+            if method_name == "system.multicall":
+                return self.system_multicall(*params)
+            if not self.mock.methods.has_key(method_name):
+                raise xmlrpclib.Fault(-1,"Could not find method %s" % method_name)
+            return self.mock.methods[method_name](*params)
+        except xmlrpclib.Fault, f:
+            self.mock.countFault(f.faultCode)
+            raise
+
+    def start(self):
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+#Write a self-signed certificate and key for localhost into cert_dir.
+#Returns (certfile,keyfile)
+def make_certificate(cert_dir,openssl="openssl"):
+    certfile = os.path.join(cert_dir,"mock-spacewalk.crt")
+    keyfile = os.path.join(cert_dir,"mock-spacewalk.key")
+    devnull_f = open(os.devnull,"w")
+    try:
+        subprocess.check_call([openssl,"req","-x509","-newkey","rsa:2048","-nodes",
+                               "-days","1","-subj","/CN=localhost",
+                               "-keyout",keyfile,"-out",certfile],
+                              stdout=devnull_f,stderr=devnull_f)
+    finally:
+        devnull_f.close()
+    return (certfile,keyfile)
+
+#Parse "method=seconds,..." into a dictionary
+def parse_method_latency(value):
+    result = {}
+    if value:
+        for item in value.split(","):
+            (method_name,seconds) = item.split("=")
+            result[method_name.strip()] = float(seconds)
+    return result
+
+def add_server_options(parser):
+    parser.add_option("","--latency",type="float",dest="latency",default=0.0,
+                      help="Seconds added to every HTTP request. Default is 0")
+    parser.add_option("","--method-latency",type="string",dest="method_latency",
+                      help="Seconds added to individual method calls, e.g. errata.create=0.2,packages.findByNvrea=0.05")
+    parser.add_option("","--session-lifetime",type="float",dest="session_lifetime",
+                      help="Seconds after which session keys expire with fault -20. By default they do not expire")
+    parser.add_option("","--cert",type="string",dest="cert",
+                      help="Certificate to serve. By default a self-signed one is generated")
+    parser.add_option("","--key",type="string",dest="key",
+                      help="Private key for --cert")
+    parser.add_option("","--openssl",type="string",dest="openssl",default="openssl",
+                      help="openssl command used to generate the certificate. Default is openssl")
+
+#Create and start a server as set up by the options of add_server_options.
+#Returns (server,cert_dir), cert_dir being a temporary directory to remove
+#afterwards or None
+def start_server(options,port=0):
+    cert_dir = None
+    if options.cert is None:
+        cert_dir = tempfile.mkdtemp(prefix="mock-spacewalk-")
+        (certfile,keyfile) = make_certificate(cert_dir,options.openssl)
+    else:
+        (certfile,keyfile) = (options.cert,options.key)
+
+    mock = MockSpacewalk(options.latency,parse_method_latency(options.method_latency),options.session_lifetime)
+    server = MockSpacewalkServer(mock,port,certfile,keyfile)
+    server.start()
+    return (server,cert_dir)
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("","--port",type="int",dest="port",default=8443,
+                      help="Port to listen on. Default is 8443")
+    add_server_options(parser)
+    (options,args) = parser.parse_args()
+
+    (server,cert_dir) = start_server(options,options.port)
+    print "Mock Spacewalk server listening on https://127.0.0.1:%d/rpc/api" % server.getPort()
+    print "Press Ctrl-C to stop and print the call counts"
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    server.shutdown()
+    if cert_dir is not None:
+        shutil.rmtree(cert_dir)
+    stats = server.mock.getStats()
+    for (method_name,count) in sorted(stats['calls'].items()):
+        print "%-36s %8d" % (method_name,count)
+    print "HTTP requests %d, connections %d, logins %d, faults %s" % \
+          (stats['http_requests'],stats['connections'],stats['logins'],stats['faults'])
+
+if __name__ == "__main__":
+    main()
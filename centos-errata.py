@@ -29,18 +29,38 @@
 from datetime import datetime
 from optparse import OptionParser
 import ConfigParser
+import atexit
 import email
 import getpass
+import hashlib
+import httplib
+import json
 import libxml2
+import lxml.etree
 import lxml.html
+import mmap
+import multiprocessing
 import os
+import Queue
 import re
-import rpm
+import select
+import socket
+import sqlite3
+import struct
 import sys
+import threading
+import time
 import traceback
-import urllib
+import urllib2
+import urlparse
 import xmlrpclib
 
+#Without the rpm bindings package headers are read by LeanRPMReader
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
 class RHNSystem:
     def __init__(self,sysid,name,lastCheckin):
         self.systemid=sysid
@@ -179,6 +199,11 @@ class RHNPackage:
         result = "%s-%s-%s.%s" % (self.name,self.version,self.release,self.archLabel)
         return result
 
+    def getNVREA(self):
+        if self.epoch is None or self.epoch == "":
+            return self.getNVRA()
+        return "%s-%s:%s-%s.%s" % (self.name,self.epoch,self.version,self.release,self.archLabel)
+
 class RHNTaskoBunch:
     def __init__(self,name,description,template_names):
         self.bunchName=name
@@ -206,14 +231,184 @@ class RHNTaskoSchedule:
         print "%-20s = %s" % ("Bunch Name:",self.bunchName)
         print "%-20s = %s" % ("Job Label:",self.jobLabel)
     
+#Raised by PersistentTransport.sendRequest when the request failed
+#before the server can have handled it, so it is safe to send again
+class StaleConnectionError(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+    def __str__(self):
+        return str(self.reason)
+
+#XMLRPC transport which keeps its HTTPS connection open between calls
+#instead of opening a new connection (and doing a new TLS handshake)
+#for every API call. If the server has closed the connection in the
+#meantime we reconnect and resend the request once, but only if the
+#server cannot have handled it already: the request could not be sent,
+#or no response at all arrived for a call which is safe to repeat
+class PersistentTransport(xmlrpclib.SafeTransport):
+
+    #Calls which must not be sent twice. Should one of these fail while
+    #we wait for the response the server may already have handled it
+    NON_IDEMPOTENT=["errata.create","errata.publish"]
+
+    METHOD_NAME="<methodName>(?P<method_name>[^<]*)</methodName>"
+    method_name_re = re.compile(METHOD_NAME)
+
+    def __init__(self):
+        xmlrpclib.SafeTransport.__init__(self)
+        self.connection = None
+        self.connectionHost = None
+        self.extraHeaders = None
+        self.connectCount = 0
+        self.reuseCount = 0
+
+    def request(self, host, handler, request_body, verbose=0):
+        self.verbose = verbose
+
+        reused = self.connection is not None and self.connectionHost == host
+
+        #Calls we can't send twice don't go over a connection the server
+        #has already closed
+        if reused and not self.isIdempotent(request_body) and self.connectionDropped():
+            reused = False
+
+        try:
+            return self.sendRequest(host, handler, request_body, reused)
+        except StaleConnectionError, e:
+            self.closeConnection()
+            if not reused:
+                raise e.reason
+        except (socket.error, httplib.HTTPException):
+            self.closeConnection()
+            raise
+
+        #The server dropped our idle connection, try again on a new one
+        return self.sendRequest(host, handler, request_body, False)
+
+    #An idle connection which the server has closed is readable at once
+    def connectionDropped(self):
+        if self.connection.sock is None:
+            return True
+        try:
+            return len(select.select([self.connection.sock],[],[],0)[0]) > 0
+        except (socket.error, select.error):
+            return True
+
+    #The method name is near the start of the request body
+    def isIdempotent(self, request_body):
+        method_name_match = PersistentTransport.method_name_re.search(request_body,0,512)
+        return method_name_match is None or not method_name_match.group('method_name') in PersistentTransport.NON_IDEMPOTENT
+
+    #Raises StaleConnectionError if the request could not be sent, or if
+    #no part of the response arrived and the call is safe to repeat.
+    #Failures after that are raised as they are
+    def sendRequest(self, host, handler, request_body, reused):
+        if not reused:
+            self.closeConnection()
+            real_host, self.extraHeaders, x509 = self.get_host_info(host)
+            self.connection = httplib.HTTPSConnection(real_host, None, **(x509 or {}))
+            self.connectionHost = host
+            self.connectCount += 1
+
+        headers = {"Content-Type" : "text/xml",
+                   "User-Agent" : self.user_agent,
+                   "Connection" : "keep-alive"}
+        headers.update(dict(self.extraHeaders or []))
+        try:
+            self.connection.request("POST", handler, request_body, headers)
+        except (socket.error, httplib.HTTPException), e:
+            raise StaleConnectionError(e)
+
+        try:
+            response = self.connection.getresponse()
+        except (socket.error, httplib.BadStatusLine), e:
+            #A status line that was received but garbled is not a dropped connection
+            nothing_received = not isinstance(e,httplib.BadStatusLine) or e.line in ("","''")
+            if nothing_received and self.isIdempotent(request_body):
+                raise StaleConnectionError(e)
+            raise
+        response_body = response.read()
+
+        if reused:
+            self.reuseCount += 1
+
+        if response.will_close:
+            self.closeConnection()
+
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError(host + handler, response.status, response.reason, response.msg)
+
+        parser, unmarshaller = self.getparser()
+        parser.feed(response_body)
+        parser.close()
+        return unmarshaller.close()
+
+    def closeConnection(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.connectionHost = None
+
+#Session key shared by one or more RHNSession objects. When the key
+#expires only one of the sessions logs in again, the others pick up
+#the new key
+class RHNSessionKey:
+
+    #Spacewalk expires session keys after an hour by default
+    LIFETIME=3600
+    #Log in again this many seconds before the key is due to expire
+    RENEW_MARGIN=300
+
+    def __init__(self):
+        self.key = None
+        self.loginTime = None
+        self.lock = threading.Lock()
+        self.loginCount = 0
+
+    def isExpiring(self):
+        if self.loginTime is None:
+            return True
+        return time.time() - self.loginTime > RHNSessionKey.LIFETIME - RHNSessionKey.RENEW_MARGIN
+
+    #Log in with the supplied session if the key is still staleKey. If
+    #another caller has already replaced it, just use their key
+    def refresh(self,session,staleKey):
+        self.lock.acquire()
+        try:
+            if self.key == staleKey:
+                self.key = session.rhnLogin(session.login,session.password)
+                self.loginTime = time.time()
+                self.loginCount += 1
+            return self.key
+        finally:
+            self.lock.release()
+
 class RHNSession:
-    def __init__(self, servername, user, password):
+
+    #Maximum number of calls bundled into a single system.multicall request
+    MULTICALL_CHUNK=100
+
+    #How many times a call is retried after the session key has expired,
+    #and the longest we wait between attempts (seconds)
+    MAX_RETRIES=3
+    MAX_BACKOFF=8
+
+    def __init__(self, servername, user, password, sessionKey=None):
         self.rhnServerName = servername
         self.login = user
         self.password = password
         self.rhnUrl = 'https://'+self.rhnServerName+'/rpc/api'
-        self.server = xmlrpclib.Server(self.rhnUrl)
-        self.rhnSessionKey=self.rhnLogin(self.login,self.password)
+        self.transport = PersistentTransport()
+        self.server = xmlrpclib.Server(self.rhnUrl,transport=self.transport)
+        self.multicallSupported = True
+        self.retryCount = 0
+
+        #Sessions may share a key (e.g. publishing workers) so that they
+        #log in once between them
+        if sessionKey is None:
+            sessionKey = RHNSessionKey()
+            sessionKey.refresh(self,None)
+        self.sessionKey = sessionKey
 
     @staticmethod
     def addRequiredOptions(parser):
@@ -241,27 +436,49 @@ class RHNSession:
         return mySession
 
     def rhnLogin(self, login, password): 
+        run_stats.countCall("auth.login")
         try:
             rhnSessionKey=self.server.auth.login(login,password)
         except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                print "Session expired"
-                self.rhnLogin(login,password)
-            else:
-                print "Failed to login",f
-                raise
+            print "Failed to login",f
+            raise
         return rhnSessionKey
 
+    #Calls an API method which takes the session key as its first
+    #argument. Renews the key shortly before it is due to expire and, if
+    #the server reports that it has expired anyway (fault -20), logs in
+    #again and retries up to MAX_RETRIES times with increasing delays
+    def callApi(self,methodName,*args):
+        method = getattr(self.server,methodName)
+        attempt = 0
+        while True:
+            session_key = self.currentSessionKey()
+            run_stats.countCall(methodName)
+            try:
+                return method(session_key,*args)
+            except xmlrpclib.Fault, f:
+                if f.faultCode!=-20 or attempt >= RHNSession.MAX_RETRIES:
+                    raise
+                attempt += 1
+                self.sessionExpired(session_key,attempt)
+
+    def currentSessionKey(self):
+        session_key = self.sessionKey.key
+        if self.sessionKey.isExpiring():
+            session_key = self.sessionKey.refresh(self,session_key)
+        return session_key
+
+    #Called when a call made with session_key failed with fault -20. Waits
+    #before all but the first retry, then gets a fresh key
+    def sessionExpired(self,session_key,attempt):
+        self.retryCount += 1
+        run_stats.count("session_retries")
+        if attempt > 1:
+            time.sleep(min(2 ** (attempt-2), RHNSession.MAX_BACKOFF))
+        self.sessionKey.refresh(self,session_key)
+
     def getSystemByName(self,profileName):
-        out=[]
-        try:
-            out=self.server.system.getId(self.rhnSessionKey,profileName)                
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.getSystemByName(profileName)
-            else:
-                raise
+        out=self.callApi("system.getId",profileName)
 
         systemObj=None
         if (len(out) > 0):
@@ -270,15 +487,7 @@ class RHNSession:
         
 
     def getSystemByID(self,systemid):
-        out=[]
-        try:
-            out = self.server.system.getName(self.rhnSessionKey,systemid)
-        except xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.getSystemByID(systemid)
-            else:
-                raise
+        out = self.callApi("system.getName",systemid)
 
         systemObj=None
         if (len(out) > 0):
@@ -300,40 +509,13 @@ class RHNSession:
 
     #TODO: this should probably return an object rather than a dictionary
     def getSystemDetails(self,systemObj):
-        out={}
-        try:
-            out=self.server.system.getDetails(self.rhnSessionKey,int(systemObj.systemid))
-        except xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.getSystemDetails(systemObj)
-            else:
-                raise
-
-        return out
+        return self.callApi("system.getDetails",int(systemObj.systemid))
 
     def listGroups(self,systemObj):
-        out=[]
-        try:
-            out=self.server.system.listGroups(self.rhnSessionKey,int(systemObj.systemid))
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.listGroups(systemObj)
-            else:
-                raise
-        return out
+        return self.callApi("system.listGroups",int(systemObj.systemid))
 
     def listUserSystems(self):
-        out=[]
-        try:
-            out=self.server.system.listUserSystems(self.rhnSessionKey)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.listUserSystems()
-            else:
-                raise
+        out=self.callApi("system.listUserSystems")
 
         if (len(out) > 0):
             out2=[]
@@ -345,64 +527,21 @@ class RHNSession:
         return out
 
     def listActivationKeys(self):
-        out=[]
-        try:
-            out=self.server.activationkey.listActivationKeys(self.rhnSessionKey)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.listActivationKeys()
-            else:
-                raise
-        return out
+        return self.callApi("activationkey.listActivationKeys")
 
     def deleteSystems(self,systemObj):
-        out=[]
-        try:
-            out=self.server.system.deleteSystems(self.rhnSessionKey,systemObj.systemid)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.deleteSystems(systemObj)
-            else:
-                raise
-        return out
+        return self.callApi("system.deleteSystems",systemObj.systemid)
 
     def setGroupMembership(self,systemObj,groupid,join):
-        out=[]
-        try:
-            out = self.server.system.setGroupMembership(self.rhnSessionKey,int(systemObj.systemid),groupid,join)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.setGroupMembership(systemObj,groupid,join)
-            else:
-                raise
-        return out
+        return self.callApi("system.setGroupMembership",int(systemObj.systemid),groupid,join)
 
     def addNote(self,systemObj,label,msg):
-        out=[]
-        try:
-            out = self.server.system.addNote(self.rhnSessionKey,int(systemObj.systemid),label,msg)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.addNote(systemObj,label,msg)
-            else:
-                raise
-        return out
+        return self.callApi("system.addNote",int(systemObj.systemid),label,msg)
         
     def setCustomValues(self,systemObj,customInfoDict):
         out=[]
         if not customInfoDict is None:
-            try:
-                out = self.server.system.setCustomValues(self.rhnSessionKey,int(systemObj.systemid),customInfoDict)
-            except  xmlrpclib.Fault, f:
-                if f.faultCode==-20:
-                    self.rhnLogin(self.login,self.password)
-                    return self.setCustomValues(systemObj,customInfoDict)
-                else:
-                    raise
+            out = self.callApi("system.setCustomValues",int(systemObj.systemid),customInfoDict)
         return out
 
     def setCustomValue(self,systemObj,label,value):
@@ -412,28 +551,12 @@ class RHNSession:
     def setSystemDetails(self,systemObj,detailsDict):
         out=0
         if not detailsDict is None:
-            try:
-                out = self.server.system.setDetails(self.rhnSessionKey,int(systemObj.systemid),detailsDict)
-            except xmlrpclib.Fault, f:
-                if f.faultCode==-20:
-                    self.rhnLogin(self.login,self.password)
-                    return self.setSystemDetails(systemObj,detailsDict)
-                else:
-                    raise
+            out = self.callApi("system.setDetails",int(systemObj.systemid),detailsDict)
         return out
         
     def setNewProfileName(self,systemObj,name):
-        out=[]
-        try:
-            systemObj.name=name
-            out = self.server.system.setProfileName(self.rhnSessionKey,int(systemObj.systemid),name)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.setProfileName(systemObj,name)
-            else:
-                raise
-        return out
+        systemObj.name=name
+        return self.callApi("system.setProfileName",int(systemObj.systemid),name)
 
     def setGroup(self, systemObj, groupname, join=1): 
         for c in self.listGroups():
@@ -449,40 +572,14 @@ class RHNSession:
                     print "System %s has left %s" % systemObj.name, groupname
 
     def getCustomValues(self,systemObj):
-        out={}
-        try:
-            out = self.server.system.getCustomValues(self.rhnSessionKey,int(systemObj.systemid))
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.getCustomKeyLabels()
-            else:
-                raise
-        return out
+        return self.callApi("system.getCustomValues",int(systemObj.systemid))
 
     def addCustomKey(self,keyLabel,keyDescription):
-        out=0
-        try:
-            out = self.server.system.custominfo.createKey(self.rhnSessionKey,keyLabel,keyDescription)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.addCustomKey(keyLabel,keyDescription)
-            else:
-                raise
-        return out
+        return self.callApi("system.custominfo.createKey",keyLabel,keyDescription)
     
     def getCustomKeyLabels(self):
         out=set()
-        result=[]
-        try:
-            result = self.server.system.custominfo.listAllKeys(self.rhnSessionKey)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.getCustomKeyLabels()
-            else:
-                raise
+        result = self.callApi("system.custominfo.listAllKeys")
 
         for keyInfo in result:
             out.add(keyInfo['label'])
@@ -492,12 +589,9 @@ class RHNSession:
     def getErrataDetails(self,advisoryName):
         result=None
         try:
-            result = self.server.errata.getDetails(self.rhnSessionKey,advisoryName)
+            result = self.callApi("errata.getDetails",advisoryName)
         except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.getErrataDetails(advisoryName)
-            elif f.faultCode==-208: #This seems to be the fault returned when the errata does not exist
+            if f.faultCode==-208: #This seems to be the fault returned when the errata does not exist
                 result = None                
             else:
                 raise
@@ -519,28 +613,91 @@ class RHNSession:
 
         return errata
 
-        
-    
+    #Check which of the named errata already exist on the server. Returns
+    #a dictionary mapping each advisory name to True or False. The
+    #errata.getDetails calls are bundled into system.multicall requests
+    #of at most MULTICALL_CHUNK calls each. If the server does not
+    #support multicall we fall back to calling getErrataDetails for each
+    #advisory in turn
+    def checkErrataExist(self,advisoryNames):
+        advisoryNames = list(advisoryNames)
+        result = {}
+
+        if self.multicallSupported:
+            for start in range(0,len(advisoryNames),RHNSession.MULTICALL_CHUNK):
+                chunk_result = self.multicallErrataExist(advisoryNames[start:start+RHNSession.MULTICALL_CHUNK])
+                if chunk_result is None:
+                    break
+                result.update(chunk_result)
+
+        for advisory_name in advisoryNames:
+            if not result.has_key(advisory_name):
+                result[advisory_name] = self.getErrataDetails(advisory_name) is not None
+
+        return result
+
+    #Returns the set of advisory names published in the channel
+    def listChannelErrata(self,channelLabel):
+        result = set()
+        for errata_info in self.callApi("channel.software.listErrata",channelLabel):
+            result.add(errata_info['advisory_name'])
+        return result
+
+    #Returns every package in the channel as RHNPackage objects with their ids set
+    def listChannelPackages(self,channelLabel):
+        result = []
+        for pkg_details in self.callApi("channel.software.listAllPackages",channelLabel):
+            server_pkg = RHNPackage(pkg_details['name'],pkg_details['version'],pkg_details['release'],pkg_details['epoch'],pkg_details['arch_label'])
+            server_pkg.id = pkg_details['id']
+            result.append(server_pkg)
+        return result
+
+    #Returns None if the server cannot handle system.multicall
+    def multicallErrataExist(self,advisoryNames):
+        attempt = 0
+        while True:
+            session_key = self.currentSessionKey()
+            multicall = xmlrpclib.MultiCall(self.server)
+            for advisory_name in advisoryNames:
+                multicall.errata.getDetails(session_key,advisory_name)
+
+            run_stats.countCall("system.multicall")
+            try:
+                call_results = multicall()
+            except xmlrpclib.Fault, f:
+                print "Server does not appear to support system.multicall (%s). Checking errata one at a time" % f.faultString
+                self.multicallSupported = False
+                return None
+
+            result = {}
+            try:
+                for index in range(len(advisoryNames)):
+                    try:
+                        call_results[index]
+                        result[advisoryNames[index]] = True
+                    except xmlrpclib.Fault, f:
+                        if f.faultCode==-208: #This seems to be the fault returned when the errata does not exist
+                            result[advisoryNames[index]] = False
+                        else:
+                            raise
+                return result
+            except xmlrpclib.Fault, f:
+                if f.faultCode!=-20 or attempt >= RHNSession.MAX_RETRIES:
+                    raise
+                attempt += 1
+                self.sessionExpired(session_key,attempt)
+
     def findPackageByNVREA(self,pkg_info):
-        result= None
         pkg_details = None
-        try:
-            #Fortunately this RPC method returns an empty list if the package does not exist, no need to handle an undocumented exception
-            if pkg_info.epoch:
-                result = self.server.packages.findByNvrea(self.rhnSessionKey,pkg_info.name,pkg_info.version,pkg_info.release,pkg_info.epoch,pkg_info.archLabel)
-            else:
-                result = self.server.packages.findByNvrea(self.rhnSessionKey,pkg_info.name,pkg_info.version,pkg_info.release,"",pkg_info.archLabel)
 
-            if len(result) > 0:
-                pkg_details = result[0]
-                
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.findPackageByNVREA(pkg_info)
-            else:
-                raise
+        #Fortunately this RPC method returns an empty list if the package does not exist, no need to handle an undocumented exception
+        if pkg_info.epoch:
+            result = self.callApi("packages.findByNvrea",pkg_info.name,pkg_info.version,pkg_info.release,pkg_info.epoch,pkg_info.archLabel)
+        else:
+            result = self.callApi("packages.findByNvrea",pkg_info.name,pkg_info.version,pkg_info.release,"",pkg_info.archLabel)
 
+        if len(result) > 0:
+            pkg_details = result[0]
         
         if not pkg_details is None:
             server_pkg = RHNPackage(pkg_details['name'],pkg_details['version'],pkg_details['release'],pkg_details['epoch'],pkg_details['arch_label'])
@@ -554,46 +711,24 @@ class RHNSession:
 
     #BUG: this won't find packages with an epoch in the name
     def findPackageByNameAndChecksum(self,pkg_name, pkg_checksum):
-        result= None
-        pkg_details = None
-        
-        try:
-            #Fortunately this RPC method returns an empty list if the package does not exist, no need to handle an undocumented exception
-            result = self.server.packages.search.name(self.rhnSessionKey,pkg_name)
-
-            if len(result) > 0:
-                for search_result in result:
-                    if pkg_name == search_result['name']:
-                        pkg_details = self.server.packages.getDetails(self.rhnSessionKey,search_result['id'])
-                                                
-                        if pkg_details['checksum'] == pkg_checksum:
-                            server_pkg = RHNPackage(pkg_details['name'],pkg_details['version'],pkg_details['release'],pkg_details['epoch'],pkg_details['arch_label'])
-                            server_pkg.id = pkg_details['id']
-                            server_pkg.path = pkg_details['path']
-                            server_pkg.lastModified=pkg_details['last_modified_date']
-                            return server_pkg
-                        
-                
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.findPackageByNameAndChecksum(pkg_name,pkg_checksum)
-            else:
-                raise
+        #Fortunately this RPC method returns an empty list if the package does not exist, no need to handle an undocumented exception
+        result = self.callApi("packages.search.name",pkg_name)
+
+        for search_result in result:
+            if pkg_name == search_result['name']:
+                pkg_details = self.callApi("packages.getDetails",search_result['id'])
+                                        
+                if pkg_details['checksum'] == pkg_checksum:
+                    server_pkg = RHNPackage(pkg_details['name'],pkg_details['version'],pkg_details['release'],pkg_details['epoch'],pkg_details['arch_label'])
+                    server_pkg.id = pkg_details['id']
+                    server_pkg.path = pkg_details['path']
+                    server_pkg.lastModified=pkg_details['last_modified_date']
+                    return server_pkg
 
         return None
 
     def listScheduledBunches(self):
-        result = []
-
-        try:
-            result = self.server.taskomatic.listActiveSatSchedules(self.rhnSessionKey)
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.listSchedueldBunches()
-            else:
-                raise
+        result = self.callApi("taskomatic.listActiveSatSchedules")
 
         if (len(result) > 0):
             result2=[]
@@ -606,16 +741,7 @@ class RHNSession:
 
     
     def listTaskomaticBunches(self):
-        result = []
-        
-        try:
-            result = self.server.taskomatic.listSatBunches(self.rhnSessionKey)                
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.listTaskomaticBunches()
-            else:
-                raise
+        result = self.callApi("taskomatic.listSatBunches")
 
         if (len(result) > 0):
             result2 = []
@@ -631,45 +757,22 @@ class RHNSession:
         return None
 
     def unscheduleTaskomaticBunch(self,job_label):
-        result = None
-        
-        try:
-            result = self.server.taskomatic.unscheduleSatBunch(self.rhnSessionKey,job_label)
-
-            #TODO: do something sensible with this
-            return result
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.unscheduleTaskomaticBunch(job_label)
-            else:
-                raise
-        
-        return None
+        #TODO: do something sensible with this
+        return self.callApi("taskomatic.unscheduleSatBunch",job_label)
         
     def createErrata(self,erratum):
-        result= None
-
         #Note: this method has not been tested when the errata has any bugs or keywords. Sending the value [{}] for bugs seems to cause a crash - maybe you need [{id:"12345",name:"foobug"}] or similar for it to work
         if not erratum.readyToCreate():
             raise
 
-        try:
-                result = self.server.errata.create(self.rhnSessionKey,erratum.getInfoDict(),erratum.bugs,erratum.keywords,erratum.getPackageIds(),erratum.publish,erratum.channelLabel)
-            
-        except  xmlrpclib.Fault, f:
-            if f.faultCode==-20:
-                self.rhnLogin(self.login,self.password)
-                return self.createErrata(erratum)
-            else:
-                raise
-
-        return result
+        return self.callApi("errata.create",erratum.getInfoDict(),erratum.bugs,erratum.keywords,erratum.getPackageIds(),erratum.publish,erratum.channelLabel)
 
 class ErrataCache:
     def __init__(self):
         self.templateErrata={}
         self.completeErrata={}
+        self.serverErrata=set()
+        self.incompleteErrata=set()
 
     def addTemplateErrata(self,erratum):
         self.templateErrata[erratum.advisoryName]=erratum
@@ -687,14 +790,208 @@ class ErrataCache:
             return self.completeErrata[errata_arch].has_key(errata_name)
         return False
 
+    #Record errata left out because some of their packages weren't found
+    def addIncompleteErrata(self,errata_name):
+        self.incompleteErrata.add(errata_name)
+
+    def getIncompleteErrata(self):
+        return self.incompleteErrata
+
     def getActiveArchitectures(self):
         return self.completeErrata.keys()
 
+    #Channels that any of the complete errata will be published to
+    def getPublishChannels(self):
+        channels = set()
+        for errata_for_arch in self.completeErrata.values():
+            for erratum in errata_for_arch.values():
+                channels.update(erratum.channelLabel)
+        return channels
+
+    #Record errata which are already present on the server
+    def addServerErrata(self,errata_names):
+        self.serverErrata.update(errata_names)
+
+    def hasServerErrata(self,errata_name):
+        return errata_name in self.serverErrata
+
     def getCompleteErrata(self,errata_arch):
         if self.completeErrata.has_key(errata_arch):
             return self.completeErrata[errata_arch]
         return {}
 
+#Index of the packages in each channel on the server, so package ids
+#can be looked up without a findByNvrea call per package
+class ChannelPackageIndex:
+    def __init__(self):
+        self.channelPackages={}
+
+    #The server reports a missing epoch as "", RPM headers as None
+    @staticmethod
+    def packageKey(pkg):
+        epoch = pkg.epoch
+        if epoch is None:
+            epoch = ""
+        return (pkg.name,pkg.version,pkg.release,str(epoch),pkg.archLabel)
+
+    def addChannel(self,channel_label,server_pkgs):
+        package_ids={}
+        for server_pkg in server_pkgs:
+            package_ids[ChannelPackageIndex.packageKey(server_pkg)]=server_pkg.id
+        self.channelPackages[channel_label]=package_ids
+
+    def hasChannel(self,channel_label):
+        return self.channelPackages.has_key(channel_label)
+
+    #Returns the id of the package in any of the named channels, or None
+    def findPackageId(self,channel_labels,pkg_info):
+        pkg_key = ChannelPackageIndex.packageKey(pkg_info)
+        for channel_label in channel_labels:
+            if self.channelPackages.has_key(channel_label) and self.channelPackages[channel_label].has_key(pkg_key):
+                return self.channelPackages[channel_label][pkg_key]
+        return None
+
+    #Set the ids of all packages in the erratum which are in one of its
+    #channels. Returns the packages still lacking an id
+    def fillPackageIds(self,erratum):
+        missing = []
+        for pkg_info in erratum.packages:
+            if pkg_info.id is None:
+                pkg_info.id = self.findPackageId(erratum.channelLabel,pkg_info)
+            if pkg_info.id is None:
+                missing.append(pkg_info)
+        return missing
+
+#On-disk record of the errata processed on previous runs, so errata
+#already published can be skipped without reading packages or asking
+#the server about them
+class ErrataStateDB:
+
+    #Outcomes recorded for each erratum, architecture and channel
+    PUBLISHED="published"
+    EXISTS="exists"
+    MISSING_PACKAGES="missing packages"
+    FAILED="failed"
+    #Outcomes which mean the erratum should be processed again later
+    RETRY_OUTCOMES=(MISSING_PACKAGES,FAILED)
+
+    def __init__(self,filename):
+        self.filename = filename
+        #Publishing workers share this object so access is serialised
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename,check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS errata (
+                                     advisory_name TEXT NOT NULL,
+                                     arch TEXT NOT NULL,
+                                     channel TEXT NOT NULL,
+                                     outcome TEXT NOT NULL,
+                                     processed TEXT NOT NULL,
+                                     PRIMARY KEY (advisory_name,arch,channel))""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS errata_packages (
+                                     advisory_name TEXT NOT NULL,
+                                     arch TEXT NOT NULL,
+                                     nvrea TEXT NOT NULL,
+                                     PRIMARY KEY (advisory_name,arch,nvrea))""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS high_water_marks (
+                                     source TEXT PRIMARY KEY,
+                                     msgid INTEGER NOT NULL)""")
+        self.connection.commit()
+
+    #True if the erratum is known to be on the server in all the channels
+    def isPublished(self,advisory_name,arch,channels):
+        self.lock.acquire()
+        try:
+            published = set()
+            for (channel,) in self.connection.execute("SELECT channel FROM errata WHERE advisory_name=? AND arch=? AND outcome IN (?,?)",
+                                                      (advisory_name,arch,ErrataStateDB.PUBLISHED,ErrataStateDB.EXISTS)):
+                published.add(channel)
+        finally:
+            self.lock.release()
+
+        for channel in channels:
+            if not channel in published:
+                return False
+        return True
+
+    def recordErratum(self,erratum,arch,outcome):
+        processed = datetime.now().isoformat()
+        self.lock.acquire()
+        try:
+            for channel in erratum.channelLabel:
+                self.connection.execute("INSERT OR REPLACE INTO errata VALUES (?,?,?,?,?)",
+                                        (erratum.advisoryName,arch,channel,outcome,processed))
+            if outcome == ErrataStateDB.PUBLISHED:
+                for pkg_info in erratum.packages:
+                    self.connection.execute("INSERT OR REPLACE INTO errata_packages VALUES (?,?,?)",
+                                            (erratum.advisoryName,arch,pkg_info.getNVREA()))
+            self.connection.commit()
+        finally:
+            self.lock.release()
+
+    #Highest message id handled from the mail archive at source, or None
+    def getHighWaterMark(self,source):
+        self.lock.acquire()
+        try:
+            row = self.connection.execute("SELECT msgid FROM high_water_marks WHERE source=?",(source,)).fetchone()
+        finally:
+            self.lock.release()
+        if row is None:
+            return None
+        return row[0]
+
+    def setHighWaterMark(self,source,msgid):
+        self.lock.acquire()
+        try:
+            self.connection.execute("INSERT OR REPLACE INTO high_water_marks VALUES (?,?)",(source,msgid))
+            self.connection.commit()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.connection.close()
+
+#Keeps the description and solution text scraped from RHN errata pages
+#in an SQLite database, keyed by page URL. Pages which could not be
+#downloaded are remembered too, but tried again after a day
+class RHNDescriptionCache:
+
+    NEGATIVE_LIFETIME=86400
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS rhn_descriptions (
+                                     url TEXT PRIMARY KEY,
+                                     description TEXT,
+                                     solution TEXT,
+                                     failed INTEGER NOT NULL,
+                                     fetched REAL NOT NULL)""")
+        self.connection.commit()
+
+    #Returns (description,solution) for the page, or None if it must be
+    #downloaded. Either may be None if the page didn't contain it. A
+    #failed page still within NEGATIVE_LIFETIME gives (None,None)
+    def lookupDescription(self,rhn_url):
+        row = self.connection.execute("SELECT description,solution,failed,fetched FROM rhn_descriptions WHERE url=?",(rhn_url,)).fetchone()
+        if row is None:
+            return None
+        if row[2] and time.time() - row[3] > RHNDescriptionCache.NEGATIVE_LIFETIME:
+            return None
+        return (row[0],row[1])
+
+    def addDescription(self,rhn_url,description,solution):
+        self.connection.execute("INSERT OR REPLACE INTO rhn_descriptions VALUES (?,?,?,0,?)",
+                                (rhn_url,description,solution,time.time()))
+        self.connection.commit()
+
+    def addFailure(self,rhn_url):
+        self.connection.execute("INSERT OR REPLACE INTO rhn_descriptions VALUES (?,NULL,NULL,1,?)",
+                                (rhn_url,time.time()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
 class MessageAnnounce:
 
     def __init__(self,
@@ -725,10 +1022,13 @@ class MessageAnnounce:
             return self.errataSynopsis.find("FASTTRACK") > -1
         return False
 
-    def getRHNUrl(self):
-        rhn_url = "https://rhn.redhat.com/errata/%s-%s-%s.html" % (self.errataType,self.errataYear,self.errataID)
-        rhn_url = re.sub(r"/CE","/RH",rhn_url)
-        return rhn_url
+    #rhn_base replaces the RHN errata location, e.g. with a local copy
+    def getRHNUrl(self,rhn_base=None):
+        if rhn_base is None:
+            rhn_base = RHN_ERRATA_BASE
+        rhn_page = "%s-%s-%s.html" % (self.errataType,self.errataYear,self.errataID)
+        rhn_page = re.sub(r"^CE","RH",rhn_page)
+        return rhn_base+rhn_page
 
     def getAdvisoryName(self):
         advisory_name="%s-%s:%s" % (self.errataType,self.errataYear,self.errataID) 
@@ -743,15 +1043,17 @@ class MessagePackageInfo:
 
 class MessageParser(object):
 
-    #Common regular expressions
-    ARCH_SPLIT="(?P<arch>\w+):\s*$"
-    PACKAGE_LIST="(?P<checksum>\S+)\s+(?P<pkg_filename>[\.\w-]+.rpm)"
+    #Common regular expressions. Matches either an architecture line or a
+    #package line at the start of any line in a message body. [^\S\n] is
+    #whitespace other than a newline, so matches never span lines
+    PACKAGE_SCAN="^(?:(?P<arch>\w+):[^\S\n]*$|(?P<checksum>\S+)[^\S\n]+(?P<pkg_filename>[\.\w-]+.rpm))"
 
     #Things to match in mailing list messages
     ERRATA_SUBJECT="\[CentOS-announce\] (?P<errata_type>\w{4,4})-(?P<year>\d{4,4})(:|-)(?P<errata_id>\d{4,4})\s+(?P<other_info>.*)$"
     SECURITY_INFO="(?P<severity>\w+) CentOS\s+(?P<version>\d)\s+(?P<synopsis>.*)$"
     BUG_INFO="CentOS\s+(?P<version>\d)\s+(?P<synopsis>.*)$"
     ENHANCE_INFO="CentOS\s+(?P<version>\d)\s+(?P<synopsis>.*)$"
+    SUBJECT_HEADER="^Subject:[ \t]*(?P<subject>.*(\n[ \t].*)*)"
 
     #Tags for the different advisory types
     SECURITY_ERRATA="CESA"
@@ -762,32 +1064,35 @@ class MessageParser(object):
     sec_info_re = re.compile(SECURITY_INFO)
     bug_info_re = re.compile(BUG_INFO)
     enhance_info_re = re.compile(ENHANCE_INFO)
-    arch_re = re.compile(ARCH_SPLIT)
-    packagelist_re = re.compile(PACKAGE_LIST)
+    package_scan_re = re.compile(PACKAGE_SCAN,re.MULTILINE)
+    subject_header_re = re.compile(SUBJECT_HEADER,re.MULTILINE|re.IGNORECASE)
 
     def __init__(self,options):
         self.options=options
  
-    #Chop up message into lists of packages per architecture and return
-    def processPackageList(self,message_body):
+    #Chop up message into lists of packages per architecture and return.
+    #The body is scanned once for architecture and package lines rather
+    #than being split into lines first. scan_re may replace the pattern
+    #used, keeping its arch, checksum and pkg_filename groups
+    def processPackageList(self,message_body,scan_re=None):
         arch_packages={}
 
         current_arch = None
+        current_packages = None
+
+        if scan_re is None:
+            scan_re = MessageParser.package_scan_re
     
-        for line in message_body.split('\n'):
-            arch_match = MessageParser.arch_re.match(line)
-            packagelist_match = MessageParser.packagelist_re.match(line)
-
-            if not arch_match is None:            
-                current_arch = arch_match.group('arch')
-                arch_packages[current_arch]=list()
-            elif not (current_arch is None or
-                      packagelist_match is None):
-                arch_packages[current_arch].append(
+        for line_match in scan_re.finditer(message_body):
+            if line_match.group('arch') is not None:
+                current_arch = line_match.group('arch')
+                current_packages = arch_packages[current_arch] = list()
+            elif current_packages is not None:
+                current_packages.append(
                     MessagePackageInfo(
                     current_arch,
-                    packagelist_match.group('checksum'),
-                    packagelist_match.group('pkg_filename')
+                    line_match.group('checksum'),
+                    line_match.group('pkg_filename')
                     )
                     )
                 
@@ -834,24 +1139,38 @@ class MessageParser(object):
 
         return parsed_msg
                 
+    #Pull the Subject header out of the raw message text, joining folded
+    #lines as the email module does. Much cheaper than parsing the whole
+    #message, which we only do for errata relevant to us
+    @staticmethod
+    def extractSubject(message_text):
+        header_end = message_text.find("\n\n")
+        if header_end < 0:
+            header_end = len(message_text)
+
+        subject_match = MessageParser.subject_header_re.search(message_text,0,header_end)
+        if subject_match is None:
+            return None
+
+        return subject_match.group('subject').replace("\n","")
+
     #Processes an individual mailing list message and returns a messageAnnounce object or none if parsing failed
     #Really bad parsing errors lead to an exception
     def processMessage(self,message_text):        
+        run_stats.count("messages_seen")
         try:
-            errataMsg = email.message_from_string(message_text)
-            stripNewLine = re.compile('\n')
-
-            erratum_subject = errataMsg.get("Subject")
+            erratum_subject = MessageParser.extractSubject(message_text)
             if erratum_subject is None:
+                run_stats.count("messages_filtered")
                 return None
             
-            erratum_subject = stripNewLine.sub("",erratum_subject)
-            
             parsed_msg=self.processMessageSubject(erratum_subject)
 
             if parsed_msg is None:
+                run_stats.count("messages_filtered")
                 return None
 
+            errataMsg = email.message_from_string(message_text)
             parsed_msg.errataDate = errataMsg.get("Date")
             parsed_msg.packageByArch = self.processPackageList(errataMsg.get_payload())
                     
@@ -866,9 +1185,14 @@ class MessageParser(object):
     
     #Performs parsing on the specified errata source. What this
     #actually means will vary between the different parsers
+    #Will yield MessageAnnounce objects as soon as each one is ready, or throw an exception
+    def iterParse(self):
+        raise NotImplementedError("This method is implemented in subclasses, you should not call it from MessageParser")
+
     #Will return list of MessageAnnounce objects, or throw an exception
     def parse(self):
-        raise NotImplementedError("This method is implemented in subclasses, you should not call it from MessageParser")
+        self.parsedMessages = list(self.iterParse())
+        return self.parsedMessages
 
 class ParseError(Exception):
     def __init__(self, value):
@@ -887,7 +1211,7 @@ class MessageDigest(MessageParser):
         self.inputFile=input_file
 
     
-    def parse(self):
+    def iterParse(self):
         inputData=open(self.inputFile).read()
         digestMsg=email.message_from_string(inputData)
         
@@ -900,14 +1224,10 @@ class MessageDigest(MessageParser):
         except IndexError,index_msg:
             raise ParseError("The file %s does not appear to be a digest from centos-announce" % self.input_file)
 
-        self.parsedMessages=list()
-        
         for msg in messages:
             processed = self.processMessage(msg)
             if processed is not None:
-                self.parsedMessages.append(processed)
-            
-        return self.parsedMessages
+                yield processed
 
 class MessageArchiveFile(MessageParser):
 
@@ -919,17 +1239,174 @@ class MessageArchiveFile(MessageParser):
         MessageParser.__init__(self,options)
         self.inputFile=input_file
 
-    def parse(self):
-        inputData=open(self.inputFile).read()
+    #Yields the text of each message in the archive in turn. The archive
+    #is memory mapped rather than read in, so only one message at a time
+    #is copied into memory however large the archive is
+    def splitMessages(self):
+        archive_f = open(self.inputFile,"rb")
+        try:
+            if os.fstat(archive_f.fileno()).st_size == 0:
+                yield ""
+                return
 
-        self.parsedMessages=list()
-        
-        for msg in MessageArchiveFile.splitter_re.split(inputData):
+            archive_map = mmap.mmap(archive_f.fileno(),0,access=mmap.ACCESS_READ)
+            try:
+                msg_start = 0
+                for separator_match in MessageArchiveFile.splitter_re.finditer(archive_map):
+                    yield archive_map[msg_start:separator_match.start()]
+                    msg_start = separator_match.end()
+                yield archive_map[msg_start:]
+            finally:
+                archive_map.close()
+        finally:
+            archive_f.close()
+
+    def iterParse(self):
+        for msg in self.splitMessages():
             processed = self.processMessage(msg)
             if processed is not None:
-                self.parsedMessages.append(processed)
-    
-        return self.parsedMessages
+                yield processed
+
+#Keeps pages downloaded from mail-archive.com in an SQLite database.
+#Message pages never change once posted so are served from here
+#forever. Index pages are kept with their ETag and Last-Modified headers
+#so they can be requested again conditionally. Pages are keyed by their
+#full URL, so runs against different archives can share a cache
+class PageCache:
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+                                     url TEXT PRIMARY KEY,
+                                     etag TEXT,
+                                     last_modified TEXT,
+                                     content BLOB NOT NULL)""")
+        self.connection.commit()
+
+    #Returns the cached content of the page, or None
+    def lookupPage(self,url):
+        row = self.connection.execute("SELECT content FROM pages WHERE url=?",(url,)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    #Returns (content,etag,last_modified) for the page, or None
+    def lookupValidators(self,url):
+        row = self.connection.execute("SELECT content,etag,last_modified FROM pages WHERE url=?",(url,)).fetchone()
+        if row is None:
+            return None
+        return (str(row[0]),row[1],row[2])
+
+    def storePage(self,url,content,etag=None,last_modified=None):
+        self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?,?,?,?)",
+                                (url,etag,last_modified,sqlite3.Binary(content)))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+#Downloads a series of pages on a pool of threads. Pages are returned
+#in the order they were requested, and only a bounded number are fetched
+#ahead of the caller so stopping early wastes few requests
+class PageFetcher:
+
+    #Never have more than this many requests open to a single host
+    MAX_PER_HOST=4
+
+    #Sentinel telling a fetch thread to exit
+    STOP=None
+
+    def __init__(self,workers,timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.hostLimits = {}
+        self.lock = threading.Lock()
+
+    def hostLimit(self,url):
+        host = urlparse.urlsplit(url)[1]
+        self.lock.acquire()
+        try:
+            if not self.hostLimits.has_key(host):
+                self.hostLimits[host] = threading.BoundedSemaphore(PageFetcher.MAX_PER_HOST)
+            return self.hostLimits[host]
+        finally:
+            self.lock.release()
+
+    def fetchPage(self,url):
+        host_limit = self.hostLimit(url)
+        host_limit.acquire()
+        try:
+            page_f = urllib2.urlopen(url,timeout=self.timeout)
+            try:
+                page = page_f.read()
+            finally:
+                page_f.close()
+            run_stats.count("bytes_downloaded",len(page))
+            return page
+        finally:
+            host_limit.release()
+
+    def fetchWorker(self,work_queue):
+        while True:
+            work = work_queue.get()
+            if work is PageFetcher.STOP:
+                return
+            (url,result) = work
+            try:
+                result.put((self.fetchPage(url),None,False))
+            except Exception, e:
+                result.put((None,e,False))
+
+    #Generator returning a (url,page,error,looked_up) tuple for each URL,
+    #in order. Exactly one of page and error is None. If lookup is given
+    #it is called with each URL and any page it returns is used without
+    #downloading, with looked_up set
+    def iterFetch(self,urls,lookup=None):
+        work_queue = Queue.Queue()
+        threads = []
+        for worker_index in range(self.workers):
+            worker = threading.Thread(target=self.fetchWorker,args=(work_queue,))
+            worker.daemon = True
+            worker.start()
+            threads.append(worker)
+
+        pending = []
+        urls = iter(urls)
+
+        def submit():
+            for url in urls:
+                result = Queue.Queue(1)
+                page = None
+                if lookup is not None:
+                    page = lookup(url)
+                if page is not None:
+                    result.put((page,None,True))
+                else:
+                    work_queue.put((url,result))
+                pending.append((url,result))
+                return
+
+        try:
+            for window_index in range(self.workers * 2):
+                submit()
+
+            while len(pending) > 0:
+                (url,result) = pending.pop(0)
+                (page,error,looked_up) = result.get()
+                submit()
+                yield (url,page,error,looked_up)
+        finally:
+            #Drop anything not yet started, then let the threads exit
+            try:
+                while True:
+                    work_queue.get_nowait()
+            except Queue.Empty:
+                pass
+            for worker in threads:
+                work_queue.put(PageFetcher.STOP)
+            for worker in threads:
+                worker.join()
 
 class MessageMailArchive(MessageParser):
 
@@ -938,64 +1415,75 @@ class MessageMailArchive(MessageParser):
 
     #Things to match in pages downloaded from mail-archive.com
     MAILARCHIVE_SUBJECT = "<span class=\"subject\"><a name=\"(?P<msgid>\d+)\" href=\"(?P<relurl>[\w.]+)\">(?P<subject>\[[^]]*\]\s+[^<]+)</a></span>"
-    MAILARCHIVE_DATE = "<span class=\"date\">(?P<datestr>[^<]*)</span>"
+    MAILARCHIVE_DATE = "//span[@class='date']"
+    MAILARCHIVE_BODY = "//pre"
+    #mail-archive.com wraps the long sha256 entries, putting the checksum
+    #and the package filename on separate lines. The whitespace between
+    #them may only include a newline after a checksum of 64 characters or
+    #more, shorter md5 and sha1 entries stay on one line
+    MAILARCHIVE_PACKAGES = "^(?:(?P<arch>\w+):[^\S\n]*$|(?P<checksum>\S+)(?:[^\S\n]+|(?<=\S{64})\s+)(?P<pkg_filename>[\.\w-]+.rpm))"
     
     subjects_re = re.compile(MAILARCHIVE_SUBJECT)
-    dates_re = re.compile(MAILARCHIVE_DATE)
-
-    #TODO We should really use an SGML parser instead of doing this...
-    body_start_re = re.compile("<pre>")
-    body_end_re = re.compile("</pre>")
-    checksum_re = re.compile("(?P<checksum>\S{64,})")
-    rpm_file_re = re.compile("(?P<pkg_filename>[\.\w-]+.rpm)")
+    dates_xpath = lxml.etree.XPath(MAILARCHIVE_DATE)
+    body_xpath = lxml.etree.XPath(MAILARCHIVE_BODY)
+    packages_re = re.compile(MAILARCHIVE_PACKAGES,re.MULTILINE)
     clean_subject_re = re.compile("<[^>]*>")
+    #Only the date ordered index pages are followed, the "Earlier
+    #messages" link may also lead to the thread view
+    earlier_page_re = re.compile("<a href=\"(?P<url>(?:[^\"]*/)?mail(?:list)?\d+\.html)\"[^>]*>Earlier messages</a>")
     
     def __init__(self,options):
         MessageParser.__init__(self,options)
 
-    def processMailArchiveMessage(self,parsed_msg,msg_url):
+        #Highest message id handled by an earlier run. Crawling stops here
+        self.highWaterMark = None
+        #What this run saw, for working out the next high-water mark
+        self.highestId = None
+        self.crawlComplete = False
+        self.advisoryIds = {}
+        self.unhandledIds = []
+
+    def getArchiveUrl(self):
+        #in test mode we use our predownloaded test data
+        if self.options.testmode:
+            return "file://%s/testdata/mailarchive/" % (os.path.abspath(  os.path.dirname(sys.argv[0])+"/" ))
+        return MessageMailArchive.MAILARCHIVE_BASE
+
+    #The high-water mark to record once the errata from this run have been
+    #handled, or None if it should not move. retry_advisories are errata
+    #which need processing again; the mark stays below their messages
+    def nextHighWaterMark(self,retry_advisories):
+        if not self.crawlComplete or self.highestId is None:
+            return None
+
+        next_mark = self.highestId
+        retry_ids = list(self.unhandledIds)
+        for advisory_name in retry_advisories:
+            if self.advisoryIds.has_key(advisory_name):
+                retry_ids.append(self.advisoryIds[advisory_name])
+        for msgid in retry_ids:
+            next_mark = min(next_mark,msgid-1)
+
+        if self.highWaterMark is not None and next_mark <= self.highWaterMark:
+            return None
+        return next_mark
+
+    #Complete parsed_msg from the message page downloaded from msg_url
+    def processMailArchiveMessage(self,parsed_msg,msg_url,message_src):
         
         try:
-            print "Downloading errata data from %s " % msg_url                                    
-            message_f = urllib.urlopen(msg_url)
-            message_src = message_f.read()
-            message_f.close()                                  
+            print "Downloaded errata data from %s " % msg_url                                    
 
-            dates_match = MessageMailArchive.dates_re.search(message_src,re.MULTILINE)
-            
-            if not dates_match is None:
-                parsed_msg.errataDate=dates_match.group('datestr')
-
-            #Process the message body into a form acceptable to processPackageList as mailarchive helpfully puts checksum & package on 2 lines...
-            message_body=""
-            accumulate=False
-            current_checksum=None
-            current_rpm=None
-            for line in message_src.split("\n"):
-                if MessageMailArchive.body_start_re.match(line):
-                    accumulate=True
-
-                if MessageMailArchive.body_end_re.match(line):
-                    accumulate=False
-
-                if accumulate:
-                    checksum_match = MessageMailArchive.checksum_re.match(line)
-                    rpm_match = MessageMailArchive.rpm_file_re.match(line)
-
-                    if checksum_match is not None:
-                        current_checksum = checksum_match.group('checksum')
-
-                    if rpm_match is not None:
-                        current_rpm = rpm_match.group('pkg_filename')
-
-                    if current_checksum is not None and current_rpm is not None:
-                        message_body+="%s %s\n" % (current_checksum,current_rpm)
-                        current_checksum=None
-                        current_rpm=None
-                    elif checksum_match is None and rpm_match is None:
-                        message_body+=line+"\n"                        
-            
-            parsed_msg.packageByArch = self.processPackageList(message_body)
+            #The page is parsed once and the packages are read straight
+            #from the text of the message body
+            parsed_page = lxml.html.fromstring(message_src)
+
+            dates = MessageMailArchive.dates_xpath(parsed_page)
+            if len(dates) > 0:
+                parsed_msg.errataDate=dates[0].text_content()
+
+            message_body = "\n".join([body.text_content() for body in MessageMailArchive.body_xpath(parsed_page)])
+            parsed_msg.packageByArch = self.processPackageList(message_body,MessageMailArchive.packages_re)
 
             return parsed_msg
         except Exception, e:
@@ -1004,55 +1492,255 @@ class MessageMailArchive(MessageParser):
             
         return None        
                             
-    def parse(self):
+    def iterParse(self):
 
-        #in test mode we use our predownloaded test data
+        mailarchive_url = self.getArchiveUrl()
         if self.options.testmode:
-            mailarchive_url="file://%s/testdata/mailarchive/" % (os.path.abspath(  os.path.dirname(sys.argv[0])+"/" ))
             print "Using test data at %s " % mailarchive_url
-        else:
-            mailarchive_url=MessageMailArchive.MAILARCHIVE_BASE
         
+        page_cache = None
+        if self.options.page_cache is not None:
+            page_cache = PageCache(self.options.page_cache)
+
         try:
-            messages_list_f = urllib.urlopen(mailarchive_url+"maillist.html")
-            s = messages_list_f.read()
-            messages_list_f.close()       
+            s = self.fetchIndex(mailarchive_url+"maillist.html",page_cache)
         except IOError,e:
+            if page_cache is not None:
+                page_cache.close()
             raise ParseError("Failed to open URL %s. Reason: %s" % (mailarchive_url+"maillist.html",e))
 
-        self.parsedMessages = list()
-        
-        lines = s.split("\n")
-    
-        for line in lines:
-            subjects_match = MessageMailArchive.subjects_re.match(line)
+        lookup = None
+        if page_cache is not None:
+            lookup = page_cache.lookupPage
 
-            if len(self.parsedMessages) >= self.options.max_errata:
-                print "Max errata count %d exceeded. Processing no more errata" % self.options.max_errata
-                return self.parsedMessages
+        parsed_count = 0
 
-            if subjects_match is None:
-                continue
+        #Message pages are downloaded concurrently but handled in
+        #maillist.html order, so max_errata still selects the newest
+        fetcher = PageFetcher(self.options.fetch_workers,self.options.fetch_timeout)
+        try:
+            for (msg_url,message_src,error,looked_up) in fetcher.iterFetch(self.iterMessageUrls(s,mailarchive_url,page_cache),lookup):
+                if parsed_count >= self.options.max_errata:
+                    print "Max errata count %d exceeded. Processing no more errata" % self.options.max_errata
+                    self.crawlComplete = False
+                    return
 
-            msg_subject = subjects_match.group('subject')
-            msg_subject = MessageMailArchive.clean_subject_re.sub("",msg_subject)
-            
-            parsed_msg = self.processMessageSubject(msg_subject)
+                (parsed_msg,msgid) = self.pendingMessages.pop(msg_url)
 
-            if parsed_msg is None:
-                print "Failed to process subject %s " % msg_subject
-                continue
+                if error is not None:
+                    print "Failed to process message. Reason: %s" % error
+                    self.unhandledIds.append(msgid)
+                    continue
+
+                if page_cache is not None and not looked_up:
+                    page_cache.storePage(msg_url,message_src)
+
+                parsed_msg_full = self.processMailArchiveMessage(parsed_msg,msg_url,message_src)
+                if parsed_msg_full is not None:
+                    parsed_count += 1
+                    self.advisoryIds[parsed_msg_full.getAdvisoryName()] = msgid
+                    yield parsed_msg_full
+                else:
+                    self.unhandledIds.append(msgid)
+        finally:
+            if page_cache is not None:
+                page_cache.close()
+
+    #Download a message index page. If a cache is given the page is only
+    #transferred when it has changed since it was cached
+    def fetchIndex(self,index_url,page_cache):
+        cached = None
+        request = urllib2.Request(index_url)
+        if page_cache is not None:
+            cached = page_cache.lookupValidators(index_url)
+        if cached is not None:
+            (content,etag,last_modified) = cached
+            if etag is not None:
+                request.add_header("If-None-Match",etag)
+            if last_modified is not None:
+                request.add_header("If-Modified-Since",last_modified)
+
+        try:
+            index_f = urllib2.urlopen(request,timeout=self.options.fetch_timeout)
+        except urllib2.HTTPError,e:
+            if e.code == 304 and cached is not None:
+                print "Message index %s has not changed" % index_url
+                return cached[0]
+            raise
+
+        try:
+            content = index_f.read()
+            headers = index_f.info()
+        finally:
+            index_f.close()
+        run_stats.count("bytes_downloaded",len(content))
+
+        if page_cache is not None:
+            page_cache.storePage(index_url,content,
+                                 headers.getheader("ETag"),headers.getheader("Last-Modified"))
+        return content
+
+    #Generator returning the URL of each errata message listed in
+    #maillist.html, newest first. The partially parsed message and message
+    #id for each URL are kept in pendingMessages until the
+    #page is downloaded. Stops at the high-water mark, following the
+    #links to earlier index pages until it is reached
+    def iterMessageUrls(self,maillist_src,mailarchive_url,page_cache):
+        self.pendingMessages = {}
+        self.crawlComplete = False
+
+        #A message may be listed on more than one of the index pages read
+        queued_urls = set()
+
+        index_src = maillist_src
+        while True:
+            #Ids are only roughly in date order, so the rest of a page is
+            #still read after reaching the mark
+            reached_mark = False
+            for line in index_src.split("\n"):
+                subjects_match = MessageMailArchive.subjects_re.match(line)
+
+                if subjects_match is None:
+                    continue
+
+                msgid = int(subjects_match.group('msgid'))
+                if self.highWaterMark is not None and msgid <= self.highWaterMark:
+                    if not reached_mark:
+                        print "Reached message %d, which was handled by an earlier run" % msgid
+                    reached_mark = True
+                    continue
+
+                msg_url=mailarchive_url+subjects_match.group('relurl')
+                if msg_url in queued_urls:
+                    continue
+                queued_urls.add(msg_url)
+
+                if self.highestId is None or msgid > self.highestId:
+                    self.highestId = msgid
+
+                run_stats.count("messages_seen")
+                msg_subject = subjects_match.group('subject')
+                msg_subject = MessageMailArchive.clean_subject_re.sub("",msg_subject)
             
-            msg_url=mailarchive_url+subjects_match.group('relurl')
+                parsed_msg = self.processMessageSubject(msg_subject)
+
+                if parsed_msg is None:
+                    print "Failed to process subject %s " % msg_subject
+                    run_stats.count("messages_filtered")
+                    continue
             
-            parsed_msg_full = self.processMailArchiveMessage(parsed_msg,msg_url)
-            if parsed_msg_full is not None:
-                self.parsedMessages.append(parsed_msg_full)
-              
-        return self.parsedMessages
+                self.pendingMessages[msg_url] = (parsed_msg,msgid)
+                yield msg_url
+
+            #Without a mark only the first index page is read, as before
+            if self.highWaterMark is None or reached_mark:
+                self.crawlComplete = True
+                return
+
+            #The mark is not reached and there is no earlier page by date
+            #to follow, so messages may have been missed and the mark must
+            #stay where it is
+            earlier_match = MessageMailArchive.earlier_page_re.search(index_src)
+            if earlier_match is None:
+                print "No earlier index page by date to follow. Message high-water mark %d not reached" % self.highWaterMark
+                return
+
+            index_url = mailarchive_url+earlier_match.group('url').split("/")[-1]
+            try:
+                print "Following earlier messages to %s" % index_url
+                index_src = self.fetchIndex(index_url,page_cache)
+            except IOError,e:
+                print "Failed to open URL %s. Reason: %s" % (index_url,e)
+                return
+
+#Reads the NVREA of an RPM file without librpm. Only the lead and the
+#index of the main header are parsed, so just the first few KB of the
+#file are read. Signatures are not checked and the payload is ignored
+class LeanRPMReader:
+
+    LEAD_SIZE=96
+    LEAD_MAGIC="\xed\xab\xee\xdb"
+    HEADER_MAGIC="\x8e\xad\xe8"
+
+    #Header tags we want and the value types we understand
+    RPMTAG_NAME=1000
+    RPMTAG_VERSION=1001
+    RPMTAG_RELEASE=1002
+    RPMTAG_EPOCH=1003
+    RPMTAG_ARCH=1022
+    RPM_INT32_TYPE=4
+    RPM_STRING_TYPE=6
+
+    #How much of the header data store is read beyond the last wanted tag
+    STRING_READ_SIZE=1024
+
+    #Returns (number of index entries, size of data store) for the
+    #header starting at the current file position
+    @staticmethod
+    def readHeaderIntro(rpm_file):
+        intro = rpm_file.read(16)
+        if len(intro) != 16 or intro[0:3] != LeanRPMReader.HEADER_MAGIC:
+            raise ParseError("Bad RPM header magic")
+        return struct.unpack(">II",intro[8:16])
+
+    @staticmethod
+    def readPackage(pkgfile):
+        rpm_file = open(pkgfile,"rb")
+        try:
+            lead = rpm_file.read(LeanRPMReader.LEAD_SIZE)
+            if len(lead) != LeanRPMReader.LEAD_SIZE or lead[0:4] != LeanRPMReader.LEAD_MAGIC:
+                raise ParseError("%s is not an RPM file" % pkgfile)
+
+            #Skip the signature header, which is padded to a multiple of 8 bytes
+            (sig_entries,sig_size) = LeanRPMReader.readHeaderIntro(rpm_file)
+            sig_length = sig_entries*16 + sig_size
+            rpm_file.seek(sig_length + (8 - sig_length % 8) % 8,1)
+
+            (entries,store_size) = LeanRPMReader.readHeaderIntro(rpm_file)
+            index_data = rpm_file.read(entries*16)
+            if len(index_data) != entries*16:
+                raise ParseError("%s is truncated" % pkgfile)
+
+            wanted = {}
+            for entry in range(entries):
+                (tag,tag_type,offset,count) = struct.unpack(">IIII",index_data[entry*16:entry*16+16])
+                if tag in (LeanRPMReader.RPMTAG_NAME,LeanRPMReader.RPMTAG_VERSION,LeanRPMReader.RPMTAG_RELEASE,
+                           LeanRPMReader.RPMTAG_EPOCH,LeanRPMReader.RPMTAG_ARCH):
+                    wanted[tag] = (tag_type,offset)
+
+            if len(wanted) == 0:
+                raise ParseError("%s has no package name in its header" % pkgfile)
+
+            store = rpm_file.read(min(store_size,max([offset for (tag_type,offset) in wanted.values()]) + LeanRPMReader.STRING_READ_SIZE))
+        finally:
+            rpm_file.close()
+
+        values = {}
+        for (tag,(tag_type,offset)) in wanted.items():
+            if tag_type == LeanRPMReader.RPM_INT32_TYPE:
+                values[tag] = struct.unpack(">i",store[offset:offset+4])[0]
+            elif tag_type == LeanRPMReader.RPM_STRING_TYPE:
+                end = store.find("\0",offset)
+                if end < 0:
+                    raise ParseError("Header string for tag %d in %s is too long" % (tag,pkgfile))
+                values[tag] = store[offset:end]
+
+        for tag in (LeanRPMReader.RPMTAG_NAME,LeanRPMReader.RPMTAG_VERSION,LeanRPMReader.RPMTAG_RELEASE,LeanRPMReader.RPMTAG_ARCH):
+            if not values.has_key(tag):
+                raise ParseError("%s has no value for header tag %d" % (pkgfile,tag))
+
+        return RHNPackage(values[LeanRPMReader.RPMTAG_NAME],
+                          values[LeanRPMReader.RPMTAG_VERSION],
+                          values[LeanRPMReader.RPMTAG_RELEASE],
+                          values.get(LeanRPMReader.RPMTAG_EPOCH),
+                          values[LeanRPMReader.RPMTAG_ARCH])
 
 class SearchStrategy(object):
 
+    #If set, or the rpm bindings are not installed, headers are read by
+    #LeanRPMReader rather than librpm
+    useLeanReader = False
+
     def __init__(self,config):
         self.config=config
     
@@ -1062,10 +1750,28 @@ class SearchStrategy(object):
     def getName(self):
         return "BASECLASS DO NOT USE"
 
+    #Optionally examine the (package_dir,filename,checksum) files ahead
+    #of the findPackage calls for them, using a pool of processes
+    def prefetchPackages(self,package_files,processes):
+        pass
+
+    #Release anything held open by the strategy
+    def close(self):
+        pass
+
 
     #Swiped from http://www.sharms.org/blog/2009/05/21/python-rpm/ as rpm-python has no documentation
     @staticmethod
     def processRPMFile(pkgfile):        
+        if SearchStrategy.useLeanReader or rpm is None:
+            try:
+                pkgInfo = LeanRPMReader.readPackage(pkgfile)
+                run_stats.count("rpm_headers_read")
+                return pkgInfo
+            except Exception,msg:
+                print "process_pkg_file failed with exception %s. " % msg
+                return None
+
         rpmQuery = rpm.ts()
         try:
             fd = os.open(pkgfile, os.O_RDONLY)
@@ -1077,13 +1783,322 @@ class SearchStrategy(object):
             return None
 
         pkgInfo = RHNPackage(header['name'],header['version'],header['release'],header['epoch'],header['arch'])
+        run_stats.count("rpm_headers_read")
 
         return pkgInfo
 
+#On-disk index of the NVREA of the RPM files in package directories, so
+#each file's header is only read once. An entry is trusted as long as
+#the file's size, mtime and inode are unchanged
+class RPMHeaderIndex:
+
+    #Entries are committed in batches rather than one at a time
+    COMMIT_INTERVAL=200
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.refreshedDirs = set()
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS rpm_headers (
+                                     directory TEXT NOT NULL,
+                                     filename TEXT NOT NULL,
+                                     name TEXT NOT NULL,
+                                     version TEXT NOT NULL,
+                                     release TEXT NOT NULL,
+                                     epoch TEXT,
+                                     arch TEXT NOT NULL,
+                                     size INTEGER NOT NULL,
+                                     mtime REAL NOT NULL,
+                                     inode INTEGER NOT NULL,
+                                     PRIMARY KEY (directory,filename))""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS directories (
+                                     directory TEXT PRIMARY KEY,
+                                     mtime REAL NOT NULL)""")
+        self.connection.commit()
+
+    #Drop entries for files which have gone from the directory. The
+    #directory is only listed if its mtime has changed since the last run
+    def refreshDirectory(self,package_dir):
+        self.refreshedDirs.add(package_dir)
+        dir_mtime = os.stat(package_dir).st_mtime
+
+        row = self.connection.execute("SELECT mtime FROM directories WHERE directory=?",(package_dir,)).fetchone()
+        if row is not None and row[0] == dir_mtime:
+            return
+
+        present = set(os.listdir(package_dir))
+        indexed = self.connection.execute("SELECT filename FROM rpm_headers WHERE directory=?",(package_dir,)).fetchall()
+        for (filename,) in indexed:
+            if not filename in present:
+                self.connection.execute("DELETE FROM rpm_headers WHERE directory=? AND filename=?",(package_dir,filename))
+        self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?,?)",(package_dir,dir_mtime))
+        self.connection.commit()
+
+    #Returns a new RHNPackage for the file if it is indexed and unchanged,
+    #otherwise None
+    def lookupPackage(self,package_dir,filename):
+        if not package_dir in self.refreshedDirs:
+            try:
+                self.refreshDirectory(package_dir)
+            except OSError,e:
+                print "Unable to list package directory %s. Reason: %s" % (package_dir,e)
+
+        try:
+            file_stat = os.stat(package_dir+filename)
+        except OSError:
+            return None
+
+        row = self.connection.execute("SELECT name,version,release,epoch,arch,size,mtime,inode FROM rpm_headers WHERE directory=? AND filename=?",
+                                      (package_dir,filename)).fetchone()
+        if row is not None and tuple(row[5:]) == (file_stat.st_size,file_stat.st_mtime,file_stat.st_ino):
+            epoch = row[3]
+            if epoch is not None:
+                epoch = int(epoch)
+            return RHNPackage(row[0],row[1],row[2],epoch,row[4])
+
+        return None
+
+    #Returns a new RHNPackage for the file, reading its header only if
+    #the file is not indexed or has changed. None if it can't be read
+    def findPackage(self,package_dir,filename):
+        rpm_pkg_info = self.lookupPackage(package_dir,filename)
+        if rpm_pkg_info is not None:
+            return rpm_pkg_info
+
+        rpm_pkg_info = SearchStrategy.processRPMFile(package_dir+filename)
+        if rpm_pkg_info is not None:
+            self.addPackage(package_dir,filename,rpm_pkg_info)
+
+        return rpm_pkg_info
+
+    def addPackage(self,package_dir,filename,rpm_pkg_info):
+        try:
+            file_stat = os.stat(package_dir+filename)
+        except OSError:
+            return
+
+        epoch = rpm_pkg_info.epoch
+        if epoch is not None:
+            epoch = str(epoch)
+        self.connection.execute("INSERT OR REPLACE INTO rpm_headers VALUES (?,?,?,?,?,?,?,?,?,?)",
+                                (package_dir,filename,rpm_pkg_info.name,rpm_pkg_info.version,rpm_pkg_info.release,epoch,rpm_pkg_info.archLabel,
+                                 file_stat.st_size,file_stat.st_mtime,file_stat.st_ino))
+        self.uncommitted += 1
+        if self.uncommitted >= RPMHeaderIndex.COMMIT_INTERVAL:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+#Checksums of package files, compared against those announced in the
+#messages. Digests are kept by (device, inode, size, mtime) so a file
+#is only hashed once, and in a SQLite database if one is given so this
+#holds across runs
+class PackageChecksums:
+
+    #Files are hashed in chunks of this size so large packages are never
+    #held in memory
+    CHUNK_SIZE=1048576
+
+    #Number of threads hashing files at once in computeDigests
+    THREADS=4
+
+    #The announcements have used md5, sha1 and sha256 at various times
+    ALGORITHMS={32:"md5", 40:"sha1", 64:"sha256"}
+
+    def __init__(self,filename):
+        self.digests = {}
+        self.connection = None
+        if filename is not None:
+            self.connection = sqlite3.connect(filename)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                                         device INTEGER NOT NULL,
+                                         inode INTEGER NOT NULL,
+                                         size INTEGER NOT NULL,
+                                         mtime REAL NOT NULL,
+                                         algorithm TEXT NOT NULL,
+                                         digest TEXT NOT NULL,
+                                         PRIMARY KEY (device,inode,size,mtime,algorithm))""")
+            self.connection.commit()
+
+    @staticmethod
+    def getAlgorithm(checksum):
+        return PackageChecksums.ALGORITHMS.get(len(checksum))
+
+    @staticmethod
+    def fileKey(path,algorithm):
+        file_stat = os.stat(path)
+        return (file_stat.st_dev,file_stat.st_ino,file_stat.st_size,file_stat.st_mtime,algorithm)
+
+    @staticmethod
+    def hashFile(path,algorithm):
+        file_hash = hashlib.new(algorithm)
+        pkg_file = open(path,"rb")
+        try:
+            while True:
+                chunk = pkg_file.read(PackageChecksums.CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_hash.update(chunk)
+        finally:
+            pkg_file.close()
+        return file_hash.hexdigest()
+
+    def lookupDigest(self,file_key):
+        if self.digests.has_key(file_key):
+            return self.digests[file_key]
+        if self.connection is not None:
+            row = self.connection.execute("SELECT digest FROM checksums WHERE device=? AND inode=? AND size=? AND mtime=? AND algorithm=?",file_key).fetchone()
+            if row is not None:
+                self.digests[file_key] = row[0]
+                return row[0]
+        return None
+
+    def addDigest(self,file_key,digest):
+        self.digests[file_key] = digest
+        if self.connection is not None:
+            self.connection.execute("INSERT OR REPLACE INTO checksums VALUES (?,?,?,?,?,?)",file_key+(digest,))
+
+    #Hash all the (path,checksum) files not already known using THREADS
+    #threads. hashlib releases the GIL while hashing so they run in parallel
+    def computeDigests(self,package_checksums):
+        work_queue = Queue.Queue()
+        for (path,checksum) in set(package_checksums):
+            algorithm = PackageChecksums.getAlgorithm(checksum)
+            if algorithm is None:
+                continue
+            try:
+                file_key = PackageChecksums.fileKey(path,algorithm)
+            except OSError:
+                continue
+            if self.lookupDigest(file_key) is None:
+                work_queue.put((path,file_key))
+
+        if work_queue.empty():
+            return
+
+        print "Computing checksums of %d package files" % work_queue.qsize()
+        results = Queue.Queue()
+
+        def hash_worker():
+            while True:
+                try:
+                    (path,file_key) = work_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results.put((file_key,PackageChecksums.hashFile(path,file_key[4])))
+                except IOError,e:
+                    print "Unable to read %s. Reason: %s" % (path,e)
+
+        workers = []
+        for worker_index in range(PackageChecksums.THREADS):
+            worker = threading.Thread(target=hash_worker)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+
+        while not results.empty():
+            (file_key,digest) = results.get_nowait()
+            self.addDigest(file_key,digest)
+
+        if self.connection is not None:
+            self.connection.commit()
+
+    #True if the file matches the announced checksum, or the checksum is
+    #in a form we can't check
+    def verify(self,path,checksum):
+        algorithm = PackageChecksums.getAlgorithm(checksum)
+        if algorithm is None:
+            print "Warning: don't know how to verify checksum %s of %s" % (checksum,path)
+            return True
+
+        file_key = PackageChecksums.fileKey(path,algorithm)
+        digest = self.lookupDigest(file_key)
+        if digest is None:
+            digest = PackageChecksums.hashFile(path,algorithm)
+            self.addDigest(file_key,digest)
+        return digest == checksum.lower()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+
+#Runs in the header reading processes. Returns a tuple as that is
+#cheaper to send back to the parent than an RHNPackage
+def read_rpm_header(pkgfile):
+    rpm_pkg_info = SearchStrategy.processRPMFile(pkgfile)
+    if rpm_pkg_info is None:
+        return None
+    return (rpm_pkg_info.name,rpm_pkg_info.version,rpm_pkg_info.release,rpm_pkg_info.epoch,rpm_pkg_info.archLabel)
+
 class SearchDir(SearchStrategy):
 
     def __init__(self,config):
         SearchStrategy.__init__(self,config)
+
+        self.headerIndex = None
+        if config.options.header_index is not None:
+            self.headerIndex = RPMHeaderIndex(config.options.header_index)
+
+        #Headers read in advance by prefetchPackages, keyed by path
+        self.prefetchedHeaders = {}
+
+        self.checksums = None
+        if config.options.verify_checksums:
+            self.checksums = PackageChecksums(config.options.checksum_cache)
+
+    #Read the headers of the named files using a pool of processes, then
+    #hash them in parallel if we are verifying checksums. Files whose
+    #header cannot be read are not hashed, findPackage never verifies them
+    def prefetchPackages(self,package_files,processes):
+        unreadable = set()
+        if processes > 1:
+            unreadable = self.prefetchHeaders(package_files,processes)
+
+        if self.checksums is not None:
+            self.checksums.computeDigests([(package_dir+filename,checksum) for (package_dir,filename,checksum) in package_files
+                                           if not package_dir+filename in unreadable])
+
+    #Read the headers of the named files not already in the header index.
+    #Returns the paths of the files whose header could not be read
+    def prefetchHeaders(self,package_files,processes):
+        unreadable = set()
+        pkgfiles = []
+        for (package_dir,filename) in set([(package_dir,filename) for (package_dir,filename,checksum) in package_files]):
+            if self.headerIndex is not None and self.headerIndex.lookupPackage(package_dir,filename) is not None:
+                continue
+            pkgfiles.append((package_dir,filename))
+
+        if len(pkgfiles) == 0:
+            return unreadable
+
+        print "Reading %d package headers using %d processes" % (len(pkgfiles),processes)
+        pool = multiprocessing.Pool(processes)
+        try:
+            headers = pool.map(read_rpm_header,[package_dir+filename for (package_dir,filename) in pkgfiles])
+        finally:
+            pool.close()
+            pool.join()
+        run_stats.count("rpm_headers_read",len([header for header in headers if header is not None]))
+
+        for index in range(len(pkgfiles)):
+            (package_dir,filename) = pkgfiles[index]
+            if headers[index] is None:
+                unreadable.add(package_dir+filename)
+            elif self.headerIndex is not None:
+                self.headerIndex.addPackage(package_dir,filename,RHNPackage(*headers[index]))
+            else:
+                self.prefetchedHeaders[package_dir+filename] = headers[index]
+
+        return unreadable
     
     def findPackage(self,erratum,erratum_arch,pkg_info):
 
@@ -1092,13 +2107,35 @@ class SearchDir(SearchStrategy):
         else:
             package_dir = self.config.get_package_dir(erratum_arch)
 
-        #TODO: could compare checksums here
-        rpm_pkg_info = SearchStrategy.processRPMFile(package_dir+pkg_info.filename)
+        if self.prefetchedHeaders.has_key(package_dir+pkg_info.filename):
+            rpm_pkg_info = RHNPackage(*self.prefetchedHeaders[package_dir+pkg_info.filename])
+        elif self.headerIndex is not None:
+            rpm_pkg_info = self.headerIndex.findPackage(package_dir,pkg_info.filename)
+        else:
+            rpm_pkg_info = SearchStrategy.processRPMFile(package_dir+pkg_info.filename)
         if rpm_pkg_info is None:
             print "Warning: package %s%s does not exist or cannot be read." % (package_dir,pkg_info.filename)
+        elif self.checksums is not None:
+            #The file may have gone or become unreadable since its header was read
+            try:
+                checksum_ok = self.checksums.verify(package_dir+pkg_info.filename,pkg_info.checksum)
+            except (IOError,OSError),e:
+                print "Warning: unable to verify the checksum of package %s%s. Reason: %s" % (package_dir,pkg_info.filename,e)
+                checksum_ok = False
+            else:
+                if not checksum_ok:
+                    print "Warning: package %s%s does not match the announced checksum %s" % (package_dir,pkg_info.filename,pkg_info.checksum)
+            if not checksum_ok:
+                rpm_pkg_info = None
 
         return rpm_pkg_info
     
+    def close(self):
+        if self.headerIndex is not None:
+            self.headerIndex.close()
+        if self.checksums is not None:
+            self.checksums.close()
+
     def getName(self):
         return "dir"
 
@@ -1163,6 +2200,85 @@ class SearchFederated(SearchStrategy):
 
         return pkg_info
 
+    def prefetchPackages(self,package_files,processes):
+        for strategy in self.strategies:
+            strategy.prefetchPackages(package_files,processes)
+
+    def close(self):
+        for strategy in self.strategies:
+            strategy.close()
+
+#Timings and counters reported by --stats. The time of a phase is the
+#total of every period spent in it, as some phases are interleaved.
+#Counters may be updated from any thread
+class RunStats:
+
+    PHASES=["config","parse","templates","package_search","server_checks","errata_creation"]
+    COUNTERS=["messages_seen","messages_filtered","rpm_headers_read","session_retries",
+              "errata_created","errata_skipped","errata_failed","bytes_downloaded"]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+        self.completed = False
+        self.phaseTimes = dict([(phase,0.0) for phase in RunStats.PHASES])
+        self.counters = dict([(counter,0) for counter in RunStats.COUNTERS])
+        self.rpcCalls = {}
+
+    #Returns the start time to pass to endPhase
+    def startPhase(self):
+        return time.time()
+
+    def endPhase(self,phase,phase_start):
+        elapsed = time.time() - phase_start
+        self.lock.acquire()
+        try:
+            self.phaseTimes[phase] += elapsed
+        finally:
+            self.lock.release()
+
+    def count(self,counter,amount=1):
+        self.lock.acquire()
+        try:
+            self.counters[counter] += amount
+        finally:
+            self.lock.release()
+
+    def countCall(self,method_name):
+        self.lock.acquire()
+        try:
+            self.rpcCalls[method_name] = self.rpcCalls.get(method_name,0) + 1
+        finally:
+            self.lock.release()
+
+    def getReport(self):
+        self.lock.acquire()
+        try:
+            return {'start': datetime.fromtimestamp(self.startTime).isoformat(),
+                    'wall_time': time.time() - self.startTime,
+                    'completed': self.completed,
+                    'phases': dict(self.phaseTimes),
+                    'counters': dict(self.counters),
+                    'rpc_calls': dict(self.rpcCalls)}
+        finally:
+            self.lock.release()
+
+    #Write the report as JSON to filename, or to stdout if it is "-"
+    def writeReport(self,filename):
+        report = json.dumps(self.getReport(),sort_keys=True)
+        if filename == "-":
+            print report
+            return
+
+        try:
+            report_f = open(filename,"w")
+            try:
+                report_f.write(report + "\n")
+            finally:
+                report_f.close()
+        except IOError,e:
+            print "Failed to write run statistics to %s. Reason: %s" % (filename,e)
+
 class CentOSErrataConfig(object):
 
     def __init__(self,options,args):
@@ -1197,14 +2313,22 @@ class CentOSErrataConfig(object):
 CONFIG_FILE="centos-errata.cfg"
 VALID_ARCH=set(["i386","x86_64","ia64","ppc", "alpha", "sparc", "s390", "s390(x)"])
 
-#Things to match in pages downloaded from RHN
-RHN_ERRATA_DETAILS="<h2>Details</h2>(\s+)<div class=\"page-summary\">(?P<details>[\w\W\s]+)</div>(\s+)<br />(\s+)<h2>Solution</h2>"
-RHN_ERRATA_SOLUTION="<h2>Solution</h2>(\s+)<div class=\"page-summary\">(?P<solution>[\w\W\s]+)</div>(\s+)<br />(\s+)<h2>Updated packages</h2>"
+#Where errata pages are downloaded from RHN
+RHN_ERRATA_BASE="https://rhn.redhat.com/errata/"
+
+#Find the text of the Details and Solution sections of RHN errata pages
+RHN_ERRATA_DETAILS="//h2[normalize-space()='Details']/following-sibling::div[@class='page-summary'][1]"
+RHN_ERRATA_SOLUTION="//h2[normalize-space()='Solution']/following-sibling::div[@class='page-summary'][1]"
+rhn_details_xpath = lxml.etree.XPath(RHN_ERRATA_DETAILS)
+rhn_solution_xpath = lxml.etree.XPath(RHN_ERRATA_SOLUTION)
     
 #Cache of already processed errata
 errata_cache = ErrataCache()
 active_arches = []
 
+#Timings and counters for this run
+run_stats = RunStats()
+
 def process_args():
 
     config = ConfigParser.SafeConfigParser()
@@ -1220,12 +2344,38 @@ def process_args():
 
     parser.add_option("","--max-errata",type="int",dest="max_errata",default=10000,
                       help="Maximum number of errata to process at once. Only relevant to format 'mail-archive.com'")
+    parser.add_option("","--fetch-workers",type="int",dest="fetch_workers",default=4,
+                      help="Number of mail-archive.com message pages or RedHat Network errata pages to download concurrently. Default is 4")
+    parser.add_option("","--fetch-timeout",type="int",dest="fetch_timeout",default=30,
+                      help="Seconds to wait for each mail-archive.com or RedHat Network page download. Default is 30")
+    parser.add_option("","--page-cache",type="string",dest="page_cache",
+                      help="Keep pages downloaded from mail-archive.com in this SQLite database so message pages are only downloaded once")
+    parser.add_option("","--stats",type="string",dest="stats",
+                      help="When the script exits write a JSON report of the time spent in each phase of the run and counts of messages, package headers, server calls, errata and downloads to this file. Use - for standard output")
+    parser.add_option("","--workers",type="int",dest="workers",default=1,
+                      help="Number of errata to publish to the Spacewalk server concurrently. Each worker opens its own session. Default is 1")
+    parser.add_option("","--state-db",type="string",dest="state_db",
+                      help="Record processed errata in this SQLite database and skip errata it shows were already published")
+    parser.add_option("","--header-index",type="string",dest="header_index",
+                      help="Keep the NVREA of RPM files in the package directories in this SQLite database so unchanged files are not read again")
+    parser.add_option("","--header-processes",type="int",dest="header_processes",default=1,
+                      help="Number of processes used to read RPM headers from the package directories. Default is 1")
+    parser.add_option("","--lean-rpm-reader",action="store_true",dest="lean_rpm_reader",default=False,
+                      help="Read package NVREA directly from the RPM header index instead of using librpm. Signatures are not checked")
+    parser.add_option("","--verify-checksums",action="store_true",dest="verify_checksums",default=False,
+                      help="Reject package files which do not match the checksum in the announcement")
+    parser.add_option("","--checksum-cache",type="string",dest="checksum_cache",
+                      help="Keep package file checksums in this SQLite database so unchanged files are not hashed again")
     parser.add_option("-c","--config",type="string",dest="config_file",
                       help="Read the specified config file in addition to the default %s" % CONFIG_FILE)
     parser.add_option("-f","--format",type="string",dest="format",default="digest",
                       help="Select input format for tool. Default is digest. Valid options are digest, archive, mail-archive.com")
     parser.add_option("","--scrape-rhn",action="store_true",dest="scrape_rhn",default=False,
                       help="Connect to the RedHat Network site and attempt to download errata information")
+    parser.add_option("","--rhn-cache",type="string",dest="rhn_cache",
+                      help="Keep the errata descriptions scraped from the RedHat Network in this SQLite database so each page is only downloaded once")
+    parser.add_option("","--rhn-url",type="string",dest="rhn_url",default=RHN_ERRATA_BASE,
+                      help="Download RedHat Network errata pages from this location instead. Default is %s" % RHN_ERRATA_BASE)
     parser.add_option("","--satellite-dir",type="string",dest="satellite_dir",default="/var/satellite",
                       help="If running on a spacewalk server, specify the location of RPM files (default: /var/satellite)")
     parser.add_option("","--show-config",action="store_true",dest="print_config", default=False,
@@ -1298,50 +2448,137 @@ def process_args():
         parser.set_defaults(satellite_dir=config.get("spacewalk","satellite_dir"))
     if config.has_option("centos errata","scrape_rhn"):
         parser.set_defaults(scrape_rhn=config.getboolean("centos errata","scrape_rhn"))
+    if config.has_option("centos errata","rhn_url"):
+        parser.set_defaults(rhn_url=config.get("centos errata","rhn_url"))
+    if config.has_option("centos errata","rhn_cache"):
+        parser.set_defaults(rhn_cache=config.get("centos errata","rhn_cache"))
     if config.has_option("centos errata", "search_strategies"):
         parser.set_defaults(search_strategies=config.get("centos errata", "search_strategies"))
     if config.has_option("centos errata", "max_errata"):
         parser.set_defaults(max_errata=config.getint("centos errata", "max_errata"))
+    if config.has_option("centos errata", "fetch_workers"):
+        parser.set_defaults(fetch_workers=config.getint("centos errata", "fetch_workers"))
+    if config.has_option("centos errata", "fetch_timeout"):
+        parser.set_defaults(fetch_timeout=config.getint("centos errata", "fetch_timeout"))
+    if config.has_option("centos errata", "page_cache"):
+        parser.set_defaults(page_cache=config.get("centos errata", "page_cache"))
+    
+    if config.has_option("centos errata", "verify_checksums"):
+        parser.set_defaults(verify_checksums=config.getboolean("centos errata", "verify_checksums"))
+    if config.has_option("centos errata", "checksum_cache"):
+        parser.set_defaults(checksum_cache=config.get("centos errata", "checksum_cache"))
+    if config.has_option("centos errata", "lean_rpm_reader"):
+        parser.set_defaults(lean_rpm_reader=config.getboolean("centos errata", "lean_rpm_reader"))
+    if config.has_option("centos errata", "header_processes"):
+        parser.set_defaults(header_processes=config.getint("centos errata", "header_processes"))
+    if config.has_option("centos errata", "header_index"):
+        parser.set_defaults(header_index=config.get("centos errata", "header_index"))
+    if config.has_option("centos errata", "state_db"):
+        parser.set_defaults(state_db=config.get("centos errata", "state_db"))
+    if config.has_option("centos errata", "workers"):
+        parser.set_defaults(workers=config.getint("centos errata", "workers"))
+    if config.has_option("centos errata", "stats"):
+        parser.set_defaults(stats=config.get("centos errata", "stats"))
     
     (options,args) = parser.parse_args()
 
     return CentOSErrataConfig(options,args)
 
-def download_description(erratum,rhn_url):
+#Fill in the erratum description and solution from the RHN details
+#prefetch_descriptions put in rhn_cache. Pages which could not be
+#downloaded leave the defaults in place
+def lookup_description(erratum,rhn_url,rhn_cache):
      if not erratum.description is None:
          return
 
-     rhn_details_re = re.compile(RHN_ERRATA_DETAILS)
-     rhn_solution_re = re.compile(RHN_ERRATA_SOLUTION)
-     
-     try:
-         print "Downloading RHN data for " + erratum.advisoryName
-         message_f = urllib.urlopen(rhn_url)
-         message_src = message_f.read()
-         message_f.close()
-
-         # This causes an error on importing CESA-2011:0927. Try truncating to last 512 bytes or something...
-         details_match = rhn_details_re.search(message_src)
-         if not details_match is None:
-             erratum.description = replace_rhn_content(details_match.group("details"))
-             
-         solution_match = rhn_solution_re.search(message_src)
-         if not solution_match is None:
-             erratum.solution = replace_rhn_content(solution_match.group("solution"))
-     except:
-         print "Failed to download details for %s, using defaults" % erratum.advisoryName
-         
-
-def replace_rhn_content(rhn_content):
+     cached = rhn_cache.lookupDescription(rhn_url)
+     if cached is None:
+         return
+
+     (description,solution) = cached
+     if description is not None:
+         erratum.description = description
+     if solution is not None:
+         erratum.solution = solution
+
+#Returns the (description,solution) text from an RHN errata page. Either
+#is None if it can't be found. The page is parsed once and the sections
+#found by their headings
+def extract_description(message_src):
+    description = None
+    solution = None
+
+    try:
+        parsed_page = lxml.html.fromstring(message_src)
+    except Exception,err:
+        print "Error parsing RHN page: %s " % err
+        return (description,solution)
+
+    details = rhn_details_xpath(parsed_page)
+    if len(details) > 0:
+        description = replace_rhn_content(details[0])
+
+    solutions = rhn_solution_xpath(parsed_page)
+    if len(solutions) > 0:
+        solution = replace_rhn_content(solutions[0])
+
+    return (description,solution)
+
+#Download the RHN pages for all the messages not already in the cache on
+#a pool of threads, and store the text extracted from them in the cache
+def prefetch_descriptions(config,msgs,rhn_cache):
+    #The list keeps the fetch order, the set makes the duplicate check cheap
+    rhn_urls = []
+    seen_urls = set()
+    for msg in msgs:
+        rhn_url = msg.getRHNUrl(config.options.rhn_url)
+        if rhn_url in seen_urls:
+            continue
+        seen_urls.add(rhn_url)
+        if rhn_cache.lookupDescription(rhn_url) is None:
+            rhn_urls.append(rhn_url)
+
+    if len(rhn_urls) == 0:
+        return
+
+    print "Downloading RHN data for %d errata" % len(rhn_urls)
+    fetcher = PageFetcher(config.options.fetch_workers,config.options.fetch_timeout)
+    for (rhn_url,message_src,error,looked_up) in fetcher.iterFetch(rhn_urls):
+        if error is not None:
+            print "Failed to download RHN page %s, using defaults. Reason: %s" % (rhn_url,error)
+            rhn_cache.addFailure(rhn_url)
+        else:
+            (description,solution) = extract_description(message_src)
+            if description is None and solution is None:
+                print "No details found in RHN page %s, using defaults" % rhn_url
+                rhn_cache.addFailure(rhn_url)
+            else:
+                rhn_cache.addDescription(rhn_url,description,solution)
+
+#Convert the section of an RHN page in rhn_section to plain text. The
+#section is modified
+def replace_rhn_content(rhn_section):
     try:
-        #Hack...
-        parsed_xml = lxml.html.fromstring(rhn_content.replace("<br />","\n"))
+        #Line breaks become newlines
+        for line_break in list(rhn_section.iter("br")):
+            line_break.tail = "\n"+(line_break.tail or "")
+            line_break.drop_tag()
+
+        #A section holding a single element is treated as that element,
+        #and leading whitespace is dropped, as when the section is parsed
+        #as a fragment on its own
+        content = rhn_section
+        if rhn_section.text is not None:
+            rhn_section.text = rhn_section.text.lstrip() or None
+        if (len(rhn_section) == 1 and rhn_section.text is None
+            and (not rhn_section[0].tail or not rhn_section[0].tail.strip())):
+            content = rhn_section[0]
 
         #Add in newlines after paragraphs
-        for para in parsed_xml.xpath("*//p"):
-            para.text = "\n%s\n" % para.text
+        for para in content.xpath("*//p"):
+            para.text = "\n%s\n" % (para.text or "")
         
-        ret = parsed_xml.text_content()
+        ret = content.text_content()
         ret = ret.replace("Red Hat Enterprise Linux", "CentOS")
     except Exception,err:
         print "Error parsing XML when processing RHN content: %s " % err
@@ -1349,7 +2586,7 @@ def replace_rhn_content(rhn_content):
 
     return ret
 
-def prepare_erratum_template(config,cache,msg):
+def prepare_erratum_template(config,cache,msg,rhn_cache=None):
     advisory_name = msg.getAdvisoryName() 
     
     if cache.hasTemplateErrata(advisory_name):
@@ -1372,8 +2609,8 @@ def prepare_erratum_template(config,cache,msg):
     erratum.product = "CentOS "+msg.centosVersion
     erratum.topic=msg.getRHNUrl()
 
-    if config.options.scrape_rhn:
-        download_description(erratum,msg.getRHNUrl())
+    if rhn_cache is not None:
+        lookup_description(erratum,msg.getRHNUrl(config.options.rhn_url),rhn_cache)
 
     if erratum.description is None:
         erratum.description =" Automatically imported CentOS erratum"
@@ -1397,10 +2634,16 @@ def prepare_erratum_template(config,cache,msg):
     cache.addTemplateErrata(erratum)    
     return erratum
     
-def prepare_errata(config,pkg_search,cache,msgs):
+#Prepare errata from msgs, which may be a generator. Returns the number
+#of messages seen
+def prepare_errata(config,pkg_search,cache,msgs,state_db,rhn_cache=None):
 
+    msg_count = 0
     for msg in msgs:
-        template = prepare_erratum_template(config,cache,msg)
+        msg_count += 1
+        phase_start = run_stats.startPhase()
+        template = prepare_erratum_template(config,cache,msg,rhn_cache)
+        run_stats.endPhase("templates",phase_start)
 
         if template is None:
             continue
@@ -1422,6 +2665,12 @@ def prepare_errata(config,pkg_search,cache,msgs):
                     )
                 continue
 
+            if state_db is not None and state_db.isPublished(template.advisoryName,template_arch,update_channel.split(',')):
+                print "Errata %s was published for architecture %s by an earlier run. Skipping" % (template.advisoryName,template_arch)
+                run_stats.count("errata_skipped")
+                errata_count+=1
+                continue
+
             for unique_channel in update_channel.split(','):
                 template.addPublishChannel(unique_channel)
 
@@ -1430,7 +2679,9 @@ def prepare_errata(config,pkg_search,cache,msgs):
                 if msg_pkginfo.filename.endswith(".src.rpm"):
                     continue
 
+                phase_start = run_stats.startPhase()
                 pkg_info = pkg_search.findPackage(template,template_arch,msg_pkginfo)
+                run_stats.endPhase("package_search",phase_start)
                 
                 if pkg_info is not None:
                     template.packages.append(pkg_info)
@@ -1442,11 +2693,176 @@ def prepare_errata(config,pkg_search,cache,msgs):
             if errata_ok:
                 cache.addCompleteErrata(template_arch,template)
                 errata_count+=1
+            else:
+                cache.addIncompleteErrata(template.advisoryName)
                                   
         if errata_count == 0:        
             print "Errata '%s' contains no architectures relevant to us. Skipping" % msg.messageSubject
+
+    return msg_count
     
 
+#List the (package_dir,filename,checksum) of every binary package
+#prepare_errata will look for. Architectures without an update channel
+#or package directory, and errata the state database shows were already
+#published, are left out as they are in prepare_errata
+def gather_package_files(config,msgs,state_db):
+    package_files = []
+    for msg in msgs:
+        if msg.centosVersion != config.options.centos_version:
+            continue
+        advisory_name = msg.getAdvisoryName()
+        for msg_arch in msg.packageByArch.keys():
+            #Errata prepared from messages are never fast track
+            update_channel = config.get_update_channel(msg_arch)
+            package_dir = config.get_package_dir(msg_arch)
+            if update_channel is None or package_dir is None:
+                continue
+            if state_db is not None and state_db.isPublished(advisory_name,msg_arch,update_channel.split(',')):
+                continue
+            for msg_pkginfo in msg.packageByArch[msg_arch]:
+                if not msg_pkginfo.filename.endswith(".src.rpm"):
+                    package_files.append((package_dir,msg_pkginfo.filename,msg_pkginfo.checksum))
+    return package_files
+
+#Fetch the list of errata in each channel we are going to publish to,
+#so errata already on the server can be skipped without asking about
+#each one
+def prefetch_server_errata(session,cache):
+    for channel_label in cache.getPublishChannels():
+        try:
+            channel_errata = session.listChannelErrata(channel_label)
+            print "Channel %s already contains %d errata" % (channel_label,len(channel_errata))
+            cache.addServerErrata(channel_errata)
+        except Exception,e:
+            print "Failed to list errata in channel %s. Reason: %s" % (channel_label,e)
+
+#Index the packages in each channel we are going to publish to
+def prefetch_channel_packages(session,cache,package_index):
+    for channel_label in cache.getPublishChannels():
+        try:
+            channel_packages = session.listChannelPackages(channel_label)
+            print "Channel %s contains %d packages" % (channel_label,len(channel_packages))
+            package_index.addChannel(channel_label,channel_packages)
+        except Exception,e:
+            print "Failed to list packages in channel %s. Reason: %s" % (channel_label,e)
+
+#Check an erratum against the server, look up its packages and create
+#it. Errors are reported and the erratum skipped, they are not raised.
+#The outcome is recorded in state_db if there is one
+def publish_erratum(session,erratum,arch,existing_errata,package_index,state_db):
+    outcome = ErrataStateDB.FAILED
+    try:
+        skip = False
+        if existing_errata.has_key(erratum.advisoryName):
+            erratum_exists = existing_errata[erratum.advisoryName]
+        else:
+            erratum_exists = session.getErrataDetails(erratum.advisoryName) is not None
+
+        if erratum_exists:
+            print "Errata %s already exists on server, skipping" % erratum.advisoryName
+            #If you were going to try updating existing errata, here is where you'd do it
+            #In the 2 years that this script has existed, I've never seen a situation where we'd need to do this though
+            outcome = ErrataStateDB.EXISTS
+        else:
+            #Packages not in the channel index are looked up individually
+            for pkg_info in package_index.fillPackageIds(erratum):
+                rhn_pkg_info = session.findPackageByNVREA(pkg_info)
+                if not rhn_pkg_info is None:
+                    pkg_info.id=rhn_pkg_info.id
+                else:
+                    print "Package %s is not available on the server. " % pkg_info.getNVRA() 
+                    skip = True
+
+            if skip:
+                print "Skipping erratum %s due to missing packages" % erratum.advisoryName
+                outcome = ErrataStateDB.MISSING_PACKAGES
+            else:
+                session.createErrata(erratum)
+                outcome = ErrataStateDB.PUBLISHED
+
+    except Exception,e:
+        print "An exception occured when communicating with the server. Skipping erratum %s. Reason:" % erratum.advisoryName
+        print e
+        traceback.print_exc(file=sys.stdout)
+
+    if outcome == ErrataStateDB.PUBLISHED:
+        run_stats.count("errata_created")
+    elif outcome == ErrataStateDB.FAILED:
+        run_stats.count("errata_failed")
+    else:
+        run_stats.count("errata_skipped")
+
+    if state_db is not None:
+        try:
+            state_db.recordErratum(erratum,arch,outcome)
+        except Exception,e:
+            print "Failed to record erratum %s in state database %s. Reason: %s" % (erratum.advisoryName,state_db.filename,e)
+
+    return outcome
+
+#Publish errata using one thread per session. Each thread takes errata
+#from a shared queue until it is empty. Returns (erratum,outcome) pairs
+def publish_errata_concurrently(sessions,errata,arch,existing_errata,package_index,state_db):
+    work_queue = Queue.Queue()
+    for erratum in errata:
+        work_queue.put(erratum)
+    outcomes = []
+
+    def publish_worker(worker_session):
+        while True:
+            try:
+                erratum = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            outcomes.append((erratum,publish_erratum(worker_session,erratum,arch,existing_errata,package_index,state_db)))
+
+    workers = []
+    for worker_session in sessions:
+        worker = threading.Thread(target=publish_worker,args=(worker_session,))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+
+    return outcomes
+
+#Move the mail-archive.com high-water mark past the messages whose
+#errata have now been handled. Nothing is handled in test mode
+def advance_high_water_mark(config,message_parser,state_db,retry_advisories):
+    if config.options.testmode or state_db is None or not isinstance(message_parser,MessageMailArchive):
+        return
+
+    next_mark = message_parser.nextHighWaterMark(retry_advisories)
+    if next_mark is None:
+        print "Message high-water mark not advanced"
+        return
+
+    try:
+        state_db.setHighWaterMark(message_parser.getArchiveUrl(),next_mark)
+        print "Message high-water mark advanced to %d" % next_mark
+    except Exception,e:
+        print "Failed to record the message high-water mark in state database %s. Reason: %s" % (state_db.filename,e)
+
+#Pass on the messages from a parser, raising ParseError if parsing
+#fails. The time spent waiting for the parser is the parse phase
+def checked_messages(parsed_messages):
+    try:
+        while True:
+            phase_start = run_stats.startPhase()
+            try:
+                msg = parsed_messages.next()
+            except StopIteration:
+                return
+            finally:
+                run_stats.endPhase("parse",phase_start)
+            yield msg
+    except Exception,e:
+        traceback.print_exc(file=sys.stdout)
+        raise ParseError("Failed to parse messages due to exception %s" % e)
+
 def check_input_file(args):
     if len(args) == 0:
         print "I need an input filename. See %s --help" % sys.argv[0]
@@ -1466,8 +2882,12 @@ def check_input_file(args):
     return inputFile
 
 def main():
+    phase_start = run_stats.startPhase()
     script_config = process_args()
 
+    if script_config.options.stats is not None:
+        atexit.register(run_stats.writeReport,script_config.options.stats)
+
     if script_config.options.testmode or script_config.options.print_config:
         print "Current configuration:"
         for option,value in script_config.options.__dict__.items():
@@ -1557,25 +2977,108 @@ def main():
         print "Unknown format %s. See --help for valid formats " % script_config.options.format
         sys.exit(2)
 
+    if script_config.options.header_processes < 1:
+        print "The number of header processes must be at least 1. See %s --help" % sys.argv[0]
+        sys.exit(2)
+
+    if script_config.options.fetch_workers < 1:
+        print "The number of fetch workers must be at least 1. See %s --help" % sys.argv[0]
+        sys.exit(2)
+
+    if script_config.options.workers < 1:
+        print "The number of workers must be at least 1. See %s --help" % sys.argv[0]
+        sys.exit(2)
+
+    run_stats.endPhase("config",phase_start)
+
     session = None
+    worker_sessions = []
     if not script_config.options.testmode:
+        phase_start = run_stats.startPhase()
         session = RHNSession.establishSession(script_config.options,sys.argv[0])
+        worker_sessions.append(session)
+
+        #Each publishing worker gets its own connection to the server but
+        #they share a session key
+        for worker_index in range(1,script_config.options.workers):
+            worker_sessions.append(RHNSession(script_config.options.server,script_config.options.login,script_config.options.password,session.sessionKey))
+        run_stats.endPhase("server_checks",phase_start)
 
+    SearchStrategy.useLeanReader = script_config.options.lean_rpm_reader
     pkg_search=SearchFederated(script_config,session,search_strategies)
 
+    state_db = None
+    if script_config.options.state_db is not None:
+        try:
+            state_db = ErrataStateDB(script_config.options.state_db)
+        except Exception,e:
+            print "Unable to open state database %s. Reason: %s" % (script_config.options.state_db,e)
+            sys.exit(2)
+
+        if isinstance(message_parser,MessageMailArchive):
+            message_parser.highWaterMark = state_db.getHighWaterMark(message_parser.getArchiveUrl())
+
+    #Without a cache file the RHN details are only held for this run
+    rhn_cache = None
+    if script_config.options.scrape_rhn:
+        rhn_cache_file = script_config.options.rhn_cache
+        if rhn_cache_file is None:
+            rhn_cache_file = ":memory:"
+        try:
+            rhn_cache = RHNDescriptionCache(rhn_cache_file)
+        except Exception,e:
+            print "Unable to open RHN description cache %s. Reason: %s" % (rhn_cache_file,e)
+            sys.exit(2)
+
+    #Errata are prepared from each message as soon as it has been parsed,
+    #unless the package files or RHN pages are fetched in advance, which
+    #needs every message first
+    #The search strategies are closed even if parsing fails, so the
+    #header index and checksum cache keep what was added this run
+    parse_failed = False
     try:
-        parsed_messages=message_parser.parse()
-    except Exception,e:
-        print "Failed to parse messages due to exception %s" % e
-        traceback.print_exc(file=sys.stdout)
+        parsed_messages = checked_messages(message_parser.iterParse())
+        if script_config.options.header_processes > 1 or script_config.options.verify_checksums:
+            parsed_messages = list(parsed_messages)
+            phase_start = run_stats.startPhase()
+            pkg_search.prefetchPackages(gather_package_files(script_config,parsed_messages,state_db),script_config.options.header_processes)
+            run_stats.endPhase("package_search",phase_start)
+        if rhn_cache is not None:
+            parsed_messages = list(parsed_messages)
+            phase_start = run_stats.startPhase()
+            prefetch_descriptions(script_config,parsed_messages,rhn_cache)
+            run_stats.endPhase("templates",phase_start)
+
+        message_count = prepare_errata(script_config,pkg_search,errata_cache,parsed_messages,state_db,rhn_cache)
+    except ParseError,e:
+        print e.value
+        parse_failed = True
+    finally:
+        pkg_search.close()
+        if rhn_cache is not None:
+            rhn_cache.close()
+
+    if parse_failed:
+        if state_db is not None:
+            state_db.close()
         sys.exit(2)
-        
-    if len(parsed_messages) > 0:
-        prepare_errata(script_config,pkg_search,errata_cache,parsed_messages)
-    else:
+
+    if message_count == 0:
         print "No errata found in any of the mailing list messages"
+        advance_high_water_mark(script_config,message_parser,state_db,set())
+        run_stats.completed = True
         sys.exit(0)
 
+    package_index = ChannelPackageIndex()
+    if not script_config.options.testmode:
+        phase_start = run_stats.startPhase()
+        prefetch_server_errata(session,errata_cache)
+        prefetch_channel_packages(session,errata_cache,package_index)
+        run_stats.endPhase("server_checks",phase_start)
+
+    #Errata which will need processing again by a later run
+    retry_advisories = set(errata_cache.getIncompleteErrata())
+
     #Process any errata we have
     for arch in errata_cache.getActiveArchitectures():
         errata_for_arch=errata_cache.getCompleteErrata(arch)
@@ -1586,40 +3089,50 @@ def main():
 
         print "Arch %s: Processing %d errata..." % (arch,errata_count)
 
-        for erratum in errata_for_arch.values():
-            try:
-                if script_config.options.testmode:
-                    print "In test mode. Not checking server for existing erratum %s" % erratum.advisoryName
-                    erratum.printOut()
-                    print "------"
+        existing_errata = {}
+        if not script_config.options.testmode:
+            phase_start = run_stats.startPhase()
+            #Only errata not already seen in the channel listings need checking
+            unknown_errata = []
+            for advisory_name in errata_for_arch.keys():
+                if errata_cache.hasServerErrata(advisory_name):
+                    existing_errata[advisory_name] = True
                 else:
-                    skip = False
-                    if not session.getErrataDetails(erratum.advisoryName) is None:
-                        print "Errata %s already exists on server, skipping" % erratum.advisoryName
-                        #If you were going to try updating existing errata, here is where you'd do it
-                        #In the 2 years that this script has existed, I've never seen a situation where we'd need to do this though
-                        continue
-
-                    for pkg_info in erratum.packages:
-                        if pkg_info.id is None:
-                            rhn_pkg_info = session.findPackageByNVREA(pkg_info)
-                            if not rhn_pkg_info is None:
-                                pkg_info.id=rhn_pkg_info.id
-                            else:
-                                print "Package %s is not available on the server. " % pkg_info.getNVRA() 
-                                skip = True
-
-                    if skip:
-                        print "Skipping erratum %s due to missing packages" % erratum.advisoryName
-                        continue
-                    else:
-                        session.createErrata(erratum)
-
+                    unknown_errata.append(advisory_name)
+            try:
+                existing_errata.update(session.checkErrataExist(unknown_errata))
             except Exception,e:
-                print "An exception occured when communicating with the server. Skipping erratum %s. Reason:" % erratum.advisoryName
-                print e
-                traceback.print_exc(file=sys.stdout)
+                print "Failed to check server for existing errata, checking each erratum individually. Reason: %s" % e
+            run_stats.endPhase("server_checks",phase_start)
+
+        phase_start = run_stats.startPhase()
+        if script_config.options.testmode:
+            for erratum in errata_for_arch.values():
+                print "In test mode. Not checking server for existing erratum %s" % erratum.advisoryName
+                erratum.printOut()
+                print "------"
+        elif len(worker_sessions) > 1:
+            for (erratum,outcome) in publish_errata_concurrently(worker_sessions,errata_for_arch.values(),arch,existing_errata,package_index,state_db):
+                if outcome in ErrataStateDB.RETRY_OUTCOMES:
+                    retry_advisories.add(erratum.advisoryName)
+        else:
+            for erratum in errata_for_arch.values():
+                outcome = publish_erratum(session,erratum,arch,existing_errata,package_index,state_db)
+                if outcome in ErrataStateDB.RETRY_OUTCOMES:
+                    retry_advisories.add(erratum.advisoryName)
+        run_stats.endPhase("errata_creation",phase_start)
+
+    advance_high_water_mark(script_config,message_parser,state_db,retry_advisories)
+
+    if len(worker_sessions) > 0:
+        connect_count = sum(map((lambda worker_session: worker_session.transport.connectCount),worker_sessions))
+        reuse_count = sum(map((lambda worker_session: worker_session.transport.reuseCount),worker_sessions))
+        print "Server connections: %d opened, %d calls reused an open connection" % (connect_count,reuse_count)
+
+    if state_db is not None:
+        state_db.close()
+
+    run_stats.completed = True
 
-    
 if __name__ == "__main__":
     main() 